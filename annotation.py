@@ -1,18 +1,14 @@
-import os
-import json
+from annotation_engine import load_transcript
+from session_store import session_file
 
-def annotate_transcript(session_id, base_dir="session_data"):
+def annotate_transcript(session_id, base_dir="session_data", data=None):
 
-    session_dir = os.path.join(base_dir, session_id)
-    json_file = os.path.join(session_dir, f"{session_id}_transcriptionCW.json")
-    output_file = os.path.join(session_dir, "annotation_result.txt")
+    output_file = session_file(session_id, "annotation_result.txt", base_dir)
     
-    if not os.path.exists(json_file):
-        print(f"Error: could not find {json_file}")
-        return
-    
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    if data is None:
+        data = load_transcript(session_id, base_dir)
+        if data is None:
+            return
     
     segments = data.get("segments", [])
     annotated_lines = []
@@ -0,0 +1,102 @@
+import os
+import json
+from functools import partial
+
+from metrics import stage_timer
+from session_store import session_path
+from transcript_columnar import to_columns, from_columns, save_columns, load_columns
+
+ANNOTATORS = ("pauses", "repetitions", "syllables", "fillerwords")
+# "json" (indented, the original format) or "npz" (transcript_columnar).
+TRANSCRIPT_FORMAT = os.getenv("SATE_TRANSCRIPT_FORMAT", "json")
+
+
+def transcript_path(session_id, base_dir="session_data"):
+    return session_path(session_id, "_transcriptionCW.json", base_dir)
+
+
+def columnar_transcript_path(session_id, base_dir="session_data"):
+    return session_path(session_id, "_transcriptionCW.npz", base_dir)
+
+
+def load_transcript(session_id, base_dir="session_data"):
+    json_file = transcript_path(session_id, base_dir)
+    npz_file = columnar_transcript_path(session_id, base_dir)
+    if os.path.exists(npz_file) and (TRANSCRIPT_FORMAT == "npz" or not os.path.exists(json_file)):
+        return from_columns(load_columns(npz_file))
+    if not os.path.exists(json_file):
+        print(f"[Error] File not found: {json_file}")
+        return None
+    with open(json_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_transcript(data, session_id, base_dir="session_data", transcript_format=None):
+    """Write the transcript as JSON or columnar .npz (SATE_TRANSCRIPT_FORMAT) and drop the other copy."""
+    transcript_format = transcript_format or TRANSCRIPT_FORMAT
+    json_file = transcript_path(session_id, base_dir)
+    npz_file = columnar_transcript_path(session_id, base_dir)
+    if transcript_format == "npz":
+        path, stale = save_columns(to_columns(data), npz_file), json_file
+    else:
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        path, stale = json_file, npz_file
+    if os.path.exists(stale):
+        os.remove(stale)
+    return path
+
+
+def load_transcript_columns(session_id, base_dir="session_data"):
+    """Word arrays of a columnar transcript without building per-word dicts, or None for JSON sessions."""
+    npz_file = columnar_transcript_path(session_id, base_dir)
+    if not os.path.exists(npz_file):
+        return None
+    return load_columns(npz_file)
+
+
+def make_annotators(names, pause_threshold=0.5):
+    # Imported here because the annotator modules import this one for their wrappers.
+    from pause import annotate_segment_pauses
+    from repetition import annotate_segment_repetitions
+    from syllable import annotate_segment_syllables
+    from fillerword import annotate_segment_fillerwords
+
+    available = {
+        "pauses": partial(annotate_segment_pauses, threshold=pause_threshold),
+        "repetitions": annotate_segment_repetitions,
+        "syllables": annotate_segment_syllables,
+        "fillerwords": annotate_segment_fillerwords,
+    }
+    return [available[name] if isinstance(name, str) else name for name in names]
+
+
+def annotate_segment(segment, annotators):
+    for annotator in annotators:
+        annotator(segment)
+    return segment
+
+
+def annotate_data(data, annotators, pause_threshold=0.5):
+    annotators = make_annotators(annotators, pause_threshold)
+    with stage_timer("annotation"):
+        for segment in data.get("segments", []):
+            annotate_segment(segment, annotators)
+    return data
+
+
+def annotate_session(session_id, annotators=ANNOTATORS, base_dir="session_data", pause_threshold=0.5, data=None):
+    """Run annotators over every segment in one pass and write the transcript once.
+
+    `annotators` holds names from ANNOTATORS or callables taking a segment dict.
+    Pass `data` to annotate an already loaded transcript instead of re-reading it.
+    """
+    if data is None:
+        data = load_transcript(session_id, base_dir)
+        if data is None:
+            return None
+
+    annotate_data(data, annotators, pause_threshold)
+    json_file = save_transcript(data, session_id, base_dir)
+    print(f"Session {session_id} annotation done: {json_file}")
+    return data
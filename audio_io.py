@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+import soundfile as sf
+
+from session_store import session_path
+
+SAMPLE_RATE = 16000
+SESSION_AUDIO_SUFFIX = "_audio.npy"
+COPY_CHUNK_SAMPLES = 1 << 22
+
+
+def _ffmpeg_16k_args():
+    # Same conversion as whisperx.load_audio, so the models see identical samples.
+    return ["-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE)]
+
+
+def probe_duration(input_audio_file):
+    """Length of the recording in seconds, read from the container by ffprobe."""
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", input_audio_file]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to probe audio: {e.stderr.decode(errors='replace')}") from e
+    return float(out.decode().strip())
+
+
+def decode_audio(input_audio_file, keep_native=False, start=None, duration=None):
+    """Decode a recording once with ffmpeg.
+
+    Returns (audio, native): `audio` is 16 kHz mono float32 for transcription,
+    alignment, diarization and segment slicing. `native` is (samples, rate) at
+    the file's own rate and channel count, taken from a second output of the
+    same ffmpeg run, or None unless `keep_native` is set. `start`/`duration`
+    (seconds) decode only that part of the file.
+    """
+    window = []
+    if start is not None:
+        window += ["-ss", f"{start:.3f}"]
+    if duration is not None:
+        window += ["-t", f"{duration:.3f}"]
+    cmd = ["ffmpeg", "-nostdin", "-y", "-threads", "0", *window, "-i", input_audio_file, *_ffmpeg_16k_args(), "-"]
+    native_path = None
+    if keep_native:
+        fd, native_path = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        cmd += ["-acodec", "pcm_f32le", native_path]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+        audio = np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+        del out
+        native = sf.read(native_path, dtype="float32") if keep_native else None
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode(errors='replace')}") from e
+    finally:
+        if native_path:
+            os.remove(native_path)
+    return audio, native
+
+
+def slice_seconds(samples, sr, start, end):
+    return samples[int(start * sr):int(end * sr)]
+
+
+def seconds_to_sample(t, sr=SAMPLE_RATE):
+    return int(t * sr)
+
+
+def session_audio_path(session_id, base_dir="session_data"):
+    return session_path(session_id, SESSION_AUDIO_SUFFIX, base_dir)
+
+
+def to_pcm16(audio):
+    # Exact for audio from decode_audio, which is int16 / 32768 to begin with.
+    return np.clip(np.rint(np.asarray(audio, dtype=np.float32) * 32768.0), -32768, 32767).astype(np.int16)
+
+
+class SessionAudio:
+    """Read-only session audio; slicing gives float32 like decode_audio.
+
+    `samples` is the memmap itself: int16, or float32 for sessions stored
+    before the audio was kept as 16-bit.
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, key):
+        chunk = self.samples[key]
+        if chunk.dtype == np.int16:
+            return chunk.astype(np.float32) / np.float32(32768.0)
+        return np.array(chunk, dtype=np.float32)
+
+
+def save_session_audio(audio, session_id, base_dir="session_data"):
+    """Store the decoded 16 kHz mono audio of a session once, as 16-bit .npy."""
+    path = session_audio_path(session_id, base_dir)
+    np.save(path, to_pcm16(audio))
+    return path
+
+
+def load_session_audio(session_id, base_dir="session_data"):
+    """Session audio memory-mapped as a SessionAudio, or None if not stored."""
+    path = session_audio_path(session_id, base_dir)
+    if not os.path.exists(path):
+        return None
+    return SessionAudio(np.load(path, mmap_mode="r"))
+
+
+class SessionAudioWriter:
+    """Appends audio window by window and finishes as the session .npy.
+
+    Samples go to a raw int16 file first because the final length is only
+    known at the end; finish() copies them under an .npy header in chunks.
+    """
+
+    def __init__(self, session_id, base_dir="session_data"):
+        self.path = session_audio_path(session_id, base_dir)
+        self.raw_path = self.path + ".part"
+        self.samples = 0
+        self._raw = open(self.raw_path, "wb")
+
+    def append(self, audio):
+        audio = to_pcm16(audio)
+        self._raw.write(audio.tobytes())
+        self.samples += len(audio)
+
+    def finish(self):
+        self._raw.close()
+        # Plain reads and writes rather than memmaps, so the copy does not map
+        # the whole recording (twice) into this process.
+        header = {"descr": np.lib.format.dtype_to_descr(np.dtype(np.int16)), "fortran_order": False,
+                  "shape": (self.samples,)}
+        with open(self.raw_path, "rb") as raw, open(self.path, "wb") as out:
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(raw, out, COPY_CHUNK_SAMPLES * 2)
+        os.remove(self.raw_path)
+        return self.path
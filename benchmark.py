@@ -0,0 +1,380 @@
+import os
+import sys
+import shutil
+import argparse
+import json
+import random
+import string
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from speaker_assignment import assign_speakers
+from repetition import find_repetitions, _find_repetitions_naive
+
+
+def _timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+def _assign_speakers_iterrows(segments, diarization_segments):
+    # The original O(segments x turns) implementation, kept as the reference.
+    speaker_map = {}
+    for segment in segments:
+        max_overlap = 0
+        assigned_speaker = "Unknown"
+        for _, diar in diarization_segments.iterrows():
+            overlap_duration = max(0, min(segment["end"], diar["end"]) - max(segment["start"], diar["start"]))
+            if overlap_duration > max_overlap:
+                max_overlap = overlap_duration
+                assigned_speaker = diar["speaker"]
+        speaker_map[segment["start"]] = assigned_speaker
+    return speaker_map
+
+
+def synthetic_diarization(n_turns, n_speakers=2, seed=0):
+    rng = random.Random(seed)
+    t = 0.0
+    rows = []
+    for _ in range(n_turns):
+        start = t + rng.uniform(0.0, 0.5)
+        end = start + rng.uniform(0.3, 6.0)
+        rows.append({"start": start, "end": end, "speaker": f"SPEAKER_{rng.randrange(n_speakers):02d}"})
+        t = end - rng.uniform(0.0, 0.4)
+    return pd.DataFrame(rows)
+
+
+def synthetic_segments(n_segments, total_duration, seed=1):
+    rng = random.Random(seed)
+    bounds = sorted(rng.uniform(0, total_duration) for _ in range(2 * n_segments))
+    segments = []
+    for start, end in zip(bounds[::2], bounds[1::2]):
+        n_words = max(1, int((end - start) * 2))
+        step = (end - start) / n_words
+        words = [{"word": "w", "start": start + k * step, "end": start + (k + 1) * step} for k in range(n_words)]
+        segments.append({"start": start, "end": end, "words": words})
+    return segments
+
+
+def bench_speakers(sizes, check_size):
+    diar = synthetic_diarization(check_size)
+    segments = synthetic_segments(check_size, float(diar["end"].max()))
+    expected, legacy_time = _timed(_assign_speakers_iterrows, segments, diar)
+    actual, new_time = _timed(assign_speakers, segments, diar)
+    report = {
+        "check": {
+            "turns": check_size,
+            "identical": expected == actual,
+            "iterrows_s": round(legacy_time, 4),
+            "searchsorted_s": round(new_time, 4),
+        },
+        "scaling": [],
+    }
+    for n in sizes:
+        diar = synthetic_diarization(n)
+        segments = synthetic_segments(n, float(diar["end"].max()))
+        _, elapsed = _timed(assign_speakers, segments, diar)
+        _, word_elapsed = _timed(assign_speakers, segments, diar, return_word_speakers=True)
+        report["scaling"].append({
+            "turns": n,
+            "segments": len(segments),
+            "seconds": round(elapsed, 4),
+            "us_per_segment": round(elapsed / len(segments) * 1e6, 2),
+            "with_word_speakers_s": round(word_elapsed, 4),
+        })
+    return report
+
+
+def synthetic_tokens(n, vocab_size, seed=0, repeat_prob=0.05):
+    # Zipf-like word choice plus injected stutters so repetitions actually occur.
+    rng = random.Random(seed)
+    weights = [1.0 / (k + 1) for k in range(vocab_size)]
+    vocab = [f"w{k}" for k in range(vocab_size)]
+    tokens = []
+    while len(tokens) < n:
+        if tokens and rng.random() < repeat_prob:
+            L = rng.randint(1, min(4, len(tokens)))
+            tokens.extend(tokens[-L:] * rng.randint(1, 2))
+        else:
+            tokens.append(rng.choices(vocab, weights)[0])
+    return tokens[:n]
+
+
+def adversarial_tokens(n):
+    # "the" between unique words: every position has n/2 candidate lengths
+    # but no repetition, the worst case for scans that try each one.
+    return [word for k in range((n + 1) // 2) for word in ("the", f"u{k}")][:n]
+
+
+def bench_repetition(sizes, trials, naive_limit):
+    mismatches = 0
+    for trial in range(trials):
+        rng = random.Random(trial)
+        tokens = [str(rng.randrange(rng.randint(1, 8))) for _ in range(rng.randint(0, 120))]
+        if find_repetitions(tokens) != _find_repetitions_naive(tokens):
+            mismatches += 1
+    report = {"differential": {"random_streams": trials, "mismatches": mismatches}, "scaling": []}
+    for n in sizes:
+        for stream, tokens in (("natural", synthetic_tokens(n, vocab_size=500, seed=n)),
+                               ("adversarial", adversarial_tokens(n))):
+            reps, elapsed = _timed(find_repetitions, tokens)
+            row = {"stream": stream, "words": n, "repetitions": len(reps), "seconds": round(elapsed, 4)}
+            if n <= naive_limit:
+                naive_reps, naive_elapsed = _timed(_find_repetitions_naive, tokens)
+                row["naive_seconds"] = round(naive_elapsed, 4)
+                row["identical"] = naive_reps == reps
+            report["scaling"].append(row)
+    return report
+
+
+def _words(transcript):
+    return [w["word"].strip(string.punctuation).lower()
+            for seg in transcript.get("segments", []) for w in seg.get("words", [])
+            if w["word"].strip(string.punctuation)]
+
+
+def word_error_rate(reference, hypothesis):
+    """Word-level edit distance divided by the reference length."""
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, 1):
+        current = [i]
+        for j, hyp_word in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word)))
+        previous = current
+    return previous[-1] / max(len(reference), 1)
+
+
+def bench_precision(audio_files, num_speakers, device):
+    # Needs the real models; int8 is compared against the default (float32 on CPU) run.
+    from audio_io import probe_duration
+    from annotation_engine import load_transcript
+    from model_pool import ModelPool, model_name
+    from preprocess import process_audio_file
+
+    runs = {}
+    loads = {}
+    for precision in ("default", "int8"):
+        model_pool = ModelPool()
+        names = [model_name("whisperx", precision), "align", "diarization", model_name("crisperwhisper", precision)]
+        _, loads[precision] = _timed(model_pool.warmup, device, names, cw_device=device)
+        for path in audio_files:
+            session_id, elapsed = _timed(process_audio_file, path, num_speakers, device=device,
+                                         model_pool=model_pool, cw_devices=[device], precision=precision)
+            runs[precision, path] = (elapsed, _words(load_transcript(session_id)))
+        model_pool.clear()
+
+    report = {"device": device, "load_s": {p: round(t, 2) for p, t in loads.items()}, "files": []}
+    totals = {"audio_s": 0.0, "default_s": 0.0, "int8_s": 0.0, "words": 0, "errors": 0.0}
+    for path in audio_files:
+        duration = probe_duration(path)
+        (base_s, base_words), (int8_s, int8_words) = runs["default", path], runs["int8", path]
+        wer = word_error_rate(base_words, int8_words)
+        report["files"].append({
+            "audio": path,
+            "audio_s": round(duration, 2),
+            "default_s": round(base_s, 2),
+            "int8_s": round(int8_s, 2),
+            "default_rtf": round(base_s / duration, 3),
+            "int8_rtf": round(int8_s / duration, 3),
+            "speedup": round(base_s / int8_s, 2),
+            "words": len(base_words),
+            "wer_vs_default": round(wer, 4),
+        })
+        totals["audio_s"] += duration
+        totals["default_s"] += base_s
+        totals["int8_s"] += int8_s
+        totals["words"] += len(base_words)
+        totals["errors"] += wer * len(base_words)
+    if audio_files:
+        report["total"] = {
+            "default_rtf": round(totals["default_s"] / totals["audio_s"], 3),
+            "int8_rtf": round(totals["int8_s"] / totals["audio_s"], 3),
+            "speedup": round(totals["default_s"] / totals["int8_s"], 2),
+            "wer_vs_default": round(totals["errors"] / max(totals["words"], 1), 4),
+        }
+    return report
+
+
+class StageTimer:
+    """Wall time and peak RSS per named stage; RSS is sampled on a background thread.
+
+    start(name) closes the running stage, so it can be passed as on_stage.
+    Stages that run more than once (windows) are summed.
+    """
+
+    def __init__(self, interval=0.005):
+        import psutil
+        self.stages = {}
+        self.peak_rss = 0
+        self._process = psutil.Process()
+        self._current = None
+        self._started = 0.0
+        self._stage_peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def _rss(self):
+        return self._process.memory_info().rss
+
+    def _sample(self, interval):
+        while not self._stop.wait(interval):
+            self._stage_peak = max(self._stage_peak, self._rss())
+
+    def _close(self):
+        if self._current is None:
+            return
+        peak = max(self._stage_peak, self._rss())
+        stage = self.stages.setdefault(self._current, {"wall_s": 0.0, "peak_rss": 0, "calls": 0})
+        stage["wall_s"] += time.perf_counter() - self._started
+        stage["peak_rss"] = max(stage["peak_rss"], peak)
+        stage["calls"] += 1
+        self.peak_rss = max(self.peak_rss, peak)
+        self._current = None
+
+    def start(self, name):
+        self._close()
+        self._current = name
+        self._stage_peak = self._rss()
+        self._started = time.perf_counter()
+
+    def stop(self):
+        self._close()
+        self._stop.set()
+        self._thread.join()
+
+
+def bench_pipeline(minutes, num_speakers, real_models, device, window_seconds, cw_devices, annotators,
+                   pause_threshold, seed, keep_session):
+    """process_audio_file -> annotate_session -> feature_extraction -> annotate_transcript on synthetic audio."""
+    from model_pool import ModelPool
+    from preprocess import process_audio_file
+    from annotation_engine import annotate_session
+    from feature_extraction import feature_extraction
+    from annotation import annotate_transcript
+    from session_store import session_dir
+    from stub_models import STUB_LOADERS, synthetic_recording
+
+    fd, audio_path = tempfile.mkstemp(suffix=".wav")
+    os.close(fd)
+    try:
+        _, generate_s = _timed(synthetic_recording, audio_path, minutes * 60, num_speakers, seed)
+        audio_s = minutes * 60
+
+        model_pool = ModelPool(loaders=None if real_models else STUB_LOADERS)
+        _, load_s = _timed(model_pool.warmup, device, ["whisperx", "align", "diarization"])
+
+        timer = StageTimer()
+        t0 = time.perf_counter()
+        timer.start("setup")
+        session_id = process_audio_file(audio_path, num_speakers, device=device, model_pool=model_pool,
+                                        on_stage=timer.start, window_seconds=window_seconds,
+                                        cw_devices=cw_devices)
+        timer.start("annotation")
+        data = annotate_session(session_id, annotators, pause_threshold=pause_threshold)
+        timer.start("features")
+        feature_extraction(session_id, data=data, pause_threshold=pause_threshold)
+        timer.start("transcript")
+        annotate_transcript(session_id, data=data)
+        timer.stop()
+        total_s = time.perf_counter() - t0
+    finally:
+        os.remove(audio_path)
+
+    segments = data.get("segments", [])
+    report = {
+        "models": "real" if real_models else "stub",
+        "device": device,
+        "audio_s": audio_s,
+        "speakers": num_speakers,
+        "window_seconds": window_seconds,
+        "cw_devices": cw_devices,
+        "session_id": session_id,
+        "segments": len(segments),
+        "words": sum(len(seg.get("words", [])) for seg in segments),
+        "generate_s": round(generate_s, 2),
+        "model_load_s": round(load_s, 2),
+        "stages": {name: {
+            "wall_s": round(stage["wall_s"], 3),
+            "rtf": round(stage["wall_s"] / audio_s, 5),
+            "peak_rss_mb": round(stage["peak_rss"] / 2 ** 20, 1),
+            "calls": stage["calls"],
+        } for name, stage in timer.stages.items()},
+        "total": {
+            "wall_s": round(total_s, 3),
+            "rtf": round(total_s / audio_s, 5),
+            "peak_rss_mb": round(timer.peak_rss / 2 ** 20, 1),
+        },
+    }
+    if not keep_session:
+        shutil.rmtree(session_dir(session_id), ignore_errors=True)
+    return report
+
+
+def check_limits(report, max_rtf=None, max_peak_mb=None):
+    """Names of the limits a pipeline report exceeds (empty when within them)."""
+    exceeded = []
+    if max_rtf is not None and report["total"]["rtf"] > max_rtf:
+        exceeded.append(f"rtf {report['total']['rtf']} > {max_rtf}")
+    if max_peak_mb is not None and report["total"]["peak_rss_mb"] > max_peak_mb:
+        exceeded.append(f"peak_rss_mb {report['total']['peak_rss_mb']} > {max_peak_mb}")
+    return exceeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the SATE pipeline.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("speakers", help="Speaker assignment scaling")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000, 16000, 64000])
+    p.add_argument("--check-size", type=int, default=500)
+
+    p = sub.add_parser("repetition", help="Tandem repetition detector: differential check and scaling")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 20000, 40000])
+    p.add_argument("--trials", type=int, default=2000)
+    p.add_argument("--naive-limit", type=int, default=2000,
+                   help="Largest segment also timed with the original cubic scan")
+
+    p = sub.add_parser("precision", help="int8 vs default precision: speed and word error rate (real models)")
+    p.add_argument("audio", nargs="+", help="Fixed set of recordings to transcribe with both precisions")
+    p.add_argument("--num-speakers", type=int, default=2)
+    p.add_argument("--device", default="cpu")
+
+    p = sub.add_parser("pipeline", help="End-to-end run on synthetic audio: wall time, RTF and peak RSS per stage")
+    p.add_argument("--minutes", type=float, default=5.0, help="Length of the synthetic recording")
+    p.add_argument("--speakers", type=int, default=2)
+    p.add_argument("--real-models", action="store_true", help="Use the real models instead of the stubs")
+    p.add_argument("--device", default="cpu")
+    p.add_argument("--window-seconds", type=float, default=None)
+    p.add_argument("--cw-devices", default=None, help='e.g. "cpu*4"; default SATE_CW_DEVICES')
+    p.add_argument("--annotators", nargs="+", default=["pauses", "repetitions", "syllables", "fillerwords"])
+    p.add_argument("--pause-threshold", type=float, default=0.3)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--keep-session", action="store_true")
+    p.add_argument("--max-rtf", type=float, default=None, help="Exit with status 1 above this real-time factor")
+    p.add_argument("--max-peak-mb", type=float, default=None, help="Exit with status 1 above this peak RSS")
+
+    args = parser.parse_args()
+    np.random.seed(0)
+    if args.command == "speakers":
+        report = bench_speakers(args.sizes, args.check_size)
+    elif args.command == "repetition":
+        report = bench_repetition(args.sizes, args.trials, args.naive_limit)
+    elif args.command == "precision":
+        report = bench_precision(args.audio, args.num_speakers, args.device)
+    elif args.command == "pipeline":
+        report = bench_pipeline(args.minutes, args.speakers, args.real_models, args.device, args.window_seconds,
+                                args.cw_devices, args.annotators, args.pause_threshold, args.seed, args.keep_session)
+        report["exceeded"] = check_limits(report, args.max_rtf, args.max_peak_mb)
+    print(json.dumps(report, indent=4))
+    if report.get("exceeded"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import os
+import re
+import heapq
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from model_pool import ModelPool, default_cw_device
+from segment_asr import SAMPLE_RATE, iter_transcribe_segments
+
+# e.g. "cuda:0,cuda:1" or "cpu*4"; unset means the single default device.
+CW_DEVICES = os.getenv("SATE_CW_DEVICES")
+
+_cpu_pools = {}
+_cpu_pools_lock = threading.Lock()
+_replica = None
+
+
+def parse_cw_devices(spec):
+    """"cuda:0,cuda:1" -> ["cuda:0", "cuda:1"]; "cpu*4" (or cpux4, cpu×4) -> ["cpu"] * 4."""
+    devices = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r"(cpu)\s*[x×*]\s*(\d+)", part)
+        if match:
+            devices += [match.group(1)] * int(match.group(2))
+        else:
+            devices.append(part)
+    return devices
+
+
+def resolve_cw_devices(cw_devices=None):
+    """Device list from a spec string or list, else SATE_CW_DEVICES, else the default device."""
+    if cw_devices is None:
+        cw_devices = CW_DEVICES
+    if isinstance(cw_devices, str):
+        cw_devices = parse_cw_devices(cw_devices)
+    return list(cw_devices or []) or [default_cw_device()]
+
+
+def uses_cpu_processes(devices):
+    return len(devices) > 1 and all(device == "cpu" for device in devices)
+
+
+def segment_cost(seg):
+    # Same floor as bucket_segments: very short segments still cost a decoder pass.
+    return max(seg["end"] - seg["start"], 1.0)
+
+
+def plan_shards(costs, n):
+    """Longest first onto the least loaded replica (LPT); returns index lists in input order."""
+    heap = [(0.0, k) for k in range(n)]
+    shards = [[] for _ in range(n)]
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        load, k = heapq.heappop(heap)
+        shards[k].append(i)
+        heapq.heappush(heap, (load + costs[i], k))
+    return [sorted(shard) for shard in shards]
+
+
+def _init_cpu_replica(num_threads, name, loader):
+    global _replica
+    import torch
+    torch.set_num_threads(num_threads)
+    _replica = ModelPool(loaders={name: loader}).get(name, "cpu")
+
+
+def _transcribe_in_replica(indexed_segments):
+    index_of = {id(seg): i for i, seg in indexed_segments}
+    return [(index_of[id(seg)], entry)
+            for seg, entry in iter_transcribe_segments(_replica, [seg for _, seg in indexed_segments])]
+
+
+def _warmup_in_replica(_):
+    ModelPool().warmups["crisperwhisper"](_replica, np.zeros(SAMPLE_RATE, dtype=np.float32))
+    return os.getpid()
+
+
+def cpu_replica_pool(num_processes, name, loader):
+    """Worker processes that each load one CPU CrisperWhisper replica, kept for later requests.
+
+    The CPU threads are split between them so N replicas do not oversubscribe
+    the machine. `loader` must be picklable (a module-level function).
+    """
+    with _cpu_pools_lock:
+        if (num_processes, name) not in _cpu_pools:
+            threads = max(1, (os.cpu_count() or num_processes) // num_processes)
+            _cpu_pools[num_processes, name] = ProcessPoolExecutor(
+                num_processes, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_cpu_replica, initargs=(threads, name, loader))
+        return _cpu_pools[num_processes, name]
+
+
+def _drop_cpu_pool(num_processes, name, pool):
+    # A replica process died: the executor is unusable, so the next request
+    # starts a fresh one instead of failing until the server restarts.
+    with _cpu_pools_lock:
+        if _cpu_pools.get((num_processes, name)) is pool:
+            del _cpu_pools[num_processes, name]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_replicas():
+    """Stop every CPU replica pool. A multiprocessing child must call this
+    before it exits, or exiting waits forever on the idle replica processes."""
+    with _cpu_pools_lock:
+        pools = list(_cpu_pools.values())
+        _cpu_pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def warmup_replicas(model_pool, cw_devices=None, name="crisperwhisper"):
+    """Load (and run once) every CrisperWhisper replica before the first request."""
+    devices = resolve_cw_devices(cw_devices)
+    if uses_cpu_processes(devices):
+        pool = cpu_replica_pool(len(devices), name, model_pool.loaders[name])
+        try:
+            list(pool.map(_warmup_in_replica, range(len(devices))))
+        except BrokenProcessPool:
+            _drop_cpu_pool(len(devices), name, pool)
+            raise
+        return
+    for device in dict.fromkeys(devices):
+        model_pool.warmup(device, names=[name], cw_device=device)
+
+
+def _in_order(segments, results):
+    # Hold results back until every earlier segment is done, so callers see input order.
+    pending = {}
+    next_index = 0
+    for i, entry in results:
+        pending[i] = entry
+        while next_index in pending:
+            yield segments[next_index], pending.pop(next_index)
+            next_index += 1
+
+
+def _iter_process_results(model_pool, name, segments, shards):
+    pool = cpu_replica_pool(len(shards), name, model_pool.loaders[name])
+    try:
+        futures = [pool.submit(_transcribe_in_replica, [(i, segments[i]) for i in shard])
+                   for shard in shards if shard]
+        for future in as_completed(futures):
+            yield from future.result()
+    except BrokenProcessPool:
+        _drop_cpu_pool(len(shards), name, pool)
+        raise
+
+
+def _iter_thread_results(model_pool, name, segments, devices, shards):
+    results = queue.Queue()
+    done = object()
+    index_of = {id(seg): i for i, seg in enumerate(segments)}
+
+    def run(device, shard):
+        try:
+            asr_pipeline = model_pool.get(name, device)
+            for seg, entry in iter_transcribe_segments(asr_pipeline, [segments[i] for i in shard]):
+                results.put((index_of[id(seg)], entry))
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    threads = [threading.Thread(target=run, args=(device, shard), daemon=True)
+               for device, shard in zip(devices, shards) if shard]
+    for thread in threads:
+        thread.start()
+    finished = 0
+    while finished < len(threads):
+        item = results.get()
+        if item is done:
+            finished += 1
+        elif isinstance(item, BaseException):
+            raise item
+        else:
+            yield item
+
+
+def iter_transcribe_replicas(model_pool, segments, devices, name="crisperwhisper"):
+    """iter_transcribe_segments spread over CrisperWhisper replicas on `devices`.
+
+    Segments are split by duration so replicas finish together. Several CUDA
+    devices run one thread each against their own replica; "cpu" repeated N
+    times runs N worker processes. `name` picks the pool entry, e.g.
+    "crisperwhisper@int8" (model_pool.model_name). Results from several replicas are merged
+    back into input order; a single device keeps the plain bucketed path.
+    """
+    if len(devices) <= 1:
+        asr_pipeline = model_pool.get(name, devices[0])
+        yield from iter_transcribe_segments(asr_pipeline, segments)
+        return
+
+    shards = plan_shards([segment_cost(seg) for seg in segments], len(devices))
+    print(f"Transcribing {len(segments)} segments on {len(devices)} CrisperWhisper replicas: "
+          + ", ".join(f"{device}={len(shard)}" for device, shard in zip(devices, shards)))
+    if uses_cpu_processes(devices):
+        results = _iter_process_results(model_pool, name, segments, shards)
+    else:
+        results = _iter_thread_results(model_pool, name, segments, devices, shards)
+    yield from _in_order(segments, results)
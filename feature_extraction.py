@@ -1,52 +1,94 @@
 import os
 import json
 import re
+from bisect import bisect_left
 from collections import Counter
 
+from annotation_engine import load_transcript
+from pause_index import load_gap_index, speaker_curve, pause_stats
+from session_store import session_path
+
+FILLER_MATCH_TOLERANCE = 0.01
+
 def target_speaker(segments):
     speakers = [seg.get("speaker", "UNKNOWN") for seg in segments]
     most_common = Counter(speakers).most_common(1)
     return most_common[0][0] if most_common else "UNKNOWN"
 
-def pause_feature(session_id, base_dir="session_data"):
+def _first_word_near(starts, value, is_sorted):
+    # Index of the first word whose start is within the tolerance of `value`.
+    lo = bisect_left(starts, value - 2 * FILLER_MATCH_TOLERANCE) if is_sorted else 0
+    for i in range(lo, len(starts)):
+        if abs(starts[i] - value) < FILLER_MATCH_TOLERANCE:
+            return i
+        if is_sorted and starts[i] >= value + 2 * FILLER_MATCH_TOLERANCE:
+            break
+    return None
+
+def _filler_indices(seg):
+    fillers = seg.get("fillerwords", [])
+    if len(fillers) < 2:
+        return []
+    starts = [w.get("start", 0) for w in seg.get("words", [])]
+    is_sorted = all(a <= b for a, b in zip(starts, starts[1:]))
+    indices = []
+    for fw in fillers:
+        i = _first_word_near(starts, fw["start"], is_sorted)
+        if i is not None:
+            indices.append(i)
+    return sorted(indices)
+
+def prepare_session(data, gap_index=None, pause_threshold=None):
+    """Target-speaker view of a transcript shared by every feature group."""
+    segments = data.get("segments", [])
+    tgt_speaker = target_speaker(segments)
+    tgt_segments = [seg for seg in segments if seg.get("speaker") == tgt_speaker]
+    durations = [seg.get("end", 0) - seg.get("start", 0) for seg in tgt_segments]
+    word_counts = [len(seg.get("words", [])) for seg in tgt_segments]
+    return {
+        "target_speaker": tgt_speaker,
+        "tgt_segments": tgt_segments,
+        "durations": durations,
+        "word_counts": word_counts,
+        "filler_indices": [_filler_indices(seg) for seg in tgt_segments],
+        "total_duration": sum(durations),
+        "total_words": sum(word_counts),
+        "pause_threshold": pause_threshold,
+        "pause_curve": speaker_curve(gap_index, tgt_speaker) if gap_index is not None else None,
+    }
 
-    json_file = os.path.join(base_dir, session_id, f"{session_id}_transcriptionCW.json")
-    feature_file = os.path.join(base_dir, session_id, f"{session_id}_feature.json")
+def _load_session(session_id, base_dir, pause_threshold=None):
+    data = load_transcript(session_id, base_dir)
+    if data is None:
+        return None
+    gap_index = load_gap_index(session_id, base_dir, data=data) if pause_threshold is not None else None
+    return prepare_session(data, gap_index, pause_threshold)
 
-    if not os.path.exists(json_file):
-        print(f"[Error] transcriptionCW file not found: {json_file}")
-        return
+def write_features(session_id, features, base_dir="session_data"):
+    feature_file = session_path(session_id, "_feature.json", base_dir)
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    if os.path.exists(feature_file):
+        with open(feature_file, "r", encoding="utf-8") as f:
+            feature_data = json.load(f)
+    else:
+        feature_data = {}
 
-    segments = data.get("segments", [])
-    tgt_speaker = target_speaker(segments)
-    tgt_segments = [seg for seg in segments if seg.get("speaker") == tgt_speaker]
+    for group, feat in features.items():
+        feature_data.setdefault(group, []).append(feat)
 
-    total_words = 0
-    total_duration = 0.0
-    all_pauses = []
+    with open(feature_file, "w", encoding="utf-8") as f:
+        json.dump(feature_data, f, indent=4, ensure_ascii=False)
+    return feature_file
 
-    for seg in tgt_segments:
-        words = seg.get("words", [])
-        total_words += len(words)
-        duration = seg.get("end", 0) - seg.get("start", 0)
-        total_duration += duration
-        pauses = seg.get("pauses", [])
-        all_pauses.extend(pauses)
 
-    total_pauses = len(all_pauses)
-    pause_durations = [p["duration"] for p in all_pauses]
-    pause_total_duration = sum(pause_durations)
-    avg_pause_duration = sum(pause_durations) / total_pauses if total_pauses > 0 else 0
-    longest_pause = max(pause_durations) if pause_durations else 0
+def _pause_feat(total_pauses, pause_total_duration, longest_pause, total_words, total_duration):
+    avg_pause_duration = pause_total_duration / total_pauses if total_pauses > 0 else 0
 
     pause_density_1 = (total_pauses / total_words * 100) if total_words > 0 else 0
     pause_density_2 = (total_pauses / total_duration * 60) if total_duration > 0 else 0
     pause_proportion = (pause_total_duration / total_duration) * 100 if total_duration > 0 else 0
 
-    pause_feat = {
+    return {
         "Pause Density I": round(pause_density_1, 3),
         "Pause Density II": round(pause_density_2, 3),
         "Pause Proportion": round(pause_proportion, 3),
@@ -54,19 +96,41 @@ def pause_feature(session_id, base_dir="session_data"):
         "Longest Pause Duration": round(longest_pause, 3)
     }
 
-    if os.path.exists(feature_file):
-        with open(feature_file, "r", encoding="utf-8") as f:
-            feature_data = json.load(f)
-    else:
-        feature_data = {}
+def compute_pause_feature(session):
+    # With a threshold and gap index, pauses come from the index instead of
+    # the "pauses" already annotated on the segments.
+    if session.get("pause_curve") is not None and session.get("pause_threshold") is not None:
+        total_pauses, pause_total_duration, longest_pause = pause_stats(session["pause_curve"], session["pause_threshold"])
+        return _pause_feat(total_pauses, pause_total_duration, longest_pause,
+                           session["total_words"], session["total_duration"])
 
-    feature_data.setdefault("pause", []).append(pause_feat)
+    all_pauses = []
+    for seg in session["tgt_segments"]:
+        all_pauses.extend(seg.get("pauses", []))
 
-    with open(feature_file, "w", encoding="utf-8") as f:
-        json.dump(feature_data, f, indent=4, ensure_ascii=False)
+    pause_durations = [p["duration"] for p in all_pauses]
+    return _pause_feat(len(all_pauses), sum(pause_durations), max(pause_durations) if pause_durations else 0,
+                       session["total_words"], session["total_duration"])
 
+def pause_feature(session_id, base_dir="session_data", threshold=None):
+    session = _load_session(session_id, base_dir, pause_threshold=threshold)
+    if session is None:
+        return
+    feature_file = write_features(session_id, {"pause": compute_pause_feature(session)}, base_dir)
     print(f"[Done] Pause features written to {feature_file}")
 
+def pause_feature_curve(session_id, thresholds, base_dir="session_data"):
+    """Pause features for many thresholds from one gap index, {threshold: features}."""
+    data = load_transcript(session_id, base_dir)
+    if data is None:
+        return
+    session = prepare_session(data, gap_index=load_gap_index(session_id, base_dir, data=data))
+    curve = {}
+    for threshold in thresholds:
+        session["pause_threshold"] = threshold
+        curve[threshold] = compute_pause_feature(session)
+    return curve
+
 
 
 def get_syllable_weight(cv_pattern):
@@ -78,32 +142,19 @@ def get_syllable_weight(cv_pattern):
         return 10
     else:
         return 100
-        
-
-def syllable_feature(session_id, base_dir="session_data"):
-    json_file = os.path.join(base_dir, session_id, f"{session_id}_transcriptionCW.json")
-    feature_file = os.path.join(base_dir, session_id, f"{session_id}_feature.json")
-
-    if not os.path.exists(json_file):
-        print(f"[Error] transcriptionCW file not found: {json_file}")
-        return
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
 
-    segments = data.get("segments", [])
-    tgt_speaker = target_speaker(segments)
-    tgt_segments = [seg for seg in segments if seg.get("speaker") == tgt_speaker]
-
-    total_duration = sum(seg["end"] - seg["start"] for seg in tgt_segments)
+def compute_syllable_feature(session):
+    total_duration = session["total_duration"]
+    total_words = session["total_words"]
     syllable_types = set()
     total_syllables = 0
     total_weight = 0
     max_syllable_len = 0
     word_syllable_count = {}
-    word_counter = 0 
+    word_counter = 0
 
-    for seg in tgt_segments:
+    for seg, n_words in zip(session["tgt_segments"], session["word_counts"]):
         syllables = seg.get("syllables", [])
         for syl in syllables:
             cv = syl.get("CV_pattern", "")
@@ -112,21 +163,16 @@ def syllable_feature(session_id, base_dir="session_data"):
             total_syllables += 1
             total_weight += get_syllable_weight(cv)
             max_syllable_len = max(max_syllable_len, len(phonemes))
-            
+
             local_idx = syl.get("word_index")
             global_idx = word_counter + local_idx
             word_syllable_count[global_idx] = word_syllable_count.get(global_idx, 0) + 1
-        word_counter += len(seg.get("words", []))
-
-    all_words = []
-    for seg in tgt_segments:
-        all_words.extend(seg.get("words", []))
-    total_words = len(all_words)
+        word_counter += n_words
 
     multi_syll_2 = sum(1 for c in word_syllable_count.values() if c >= 2)
     multi_syll_3 = sum(1 for c in word_syllable_count.values() if c >= 3)
 
-    feat = {
+    return {
         "Number of Syllable Types": len(syllable_types),
         "Syllable Complexity Index": round(total_weight / total_syllables, 3) if total_syllables > 0 else 0,
         "Average Syllable Rate": round(total_syllables / total_duration, 3) if total_duration > 0 else 0,
@@ -135,17 +181,11 @@ def syllable_feature(session_id, base_dir="session_data"):
         "Proportion of Multisyllabic Words II": round((multi_syll_3 / total_words) * 100, 3) if total_words > 0 else 0
     }
 
-    if os.path.exists(feature_file):
-        with open(feature_file, "r", encoding="utf-8") as f:
-            feature_data = json.load(f)
-    else:
-        feature_data = {}
-
-    feature_data.setdefault("syllable", []).append(feat)
-
-    with open(feature_file, "w", encoding="utf-8") as f:
-        json.dump(feature_data, f, indent=4, ensure_ascii=False)
-
+def syllable_feature(session_id, base_dir="session_data"):
+    session = _load_session(session_id, base_dir)
+    if session is None:
+        return
+    feature_file = write_features(session_id, {"syllable": compute_syllable_feature(session)}, base_dir)
     print(f"[Done] Syllable features written to {feature_file}")
 
 
@@ -163,30 +203,16 @@ def get_rep_weight(length):
         return 40
 
 
-def repetition_feature(session_id, base_dir="session_data"):
-    json_file = os.path.join(base_dir, session_id, f"{session_id}_transcriptionCW.json")
-    feature_file = os.path.join(base_dir, session_id, f"{session_id}_feature.json")
-
-    if not os.path.exists(json_file):
-        print(f"[Error] transcriptionCW file not found: {json_file}")
-        return
-
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    segments = data.get("segments", [])
-    tgt_speaker = target_speaker(segments)
-    tgt_segments = [seg for seg in segments if seg.get("speaker") == tgt_speaker]
-
-    total_duration = sum(seg["end"] - seg["start"] for seg in tgt_segments)
-    total_words = sum(len(seg.get("words", [])) for seg in tgt_segments)
+def compute_repetition_feature(session):
+    total_duration = session["total_duration"]
+    total_words = session["total_words"]
 
     rep_count = 0
     rep_weights = 0
     rep_lengths = []
     rep_durations = []
 
-    for seg in tgt_segments:
+    for seg in session["tgt_segments"]:
         words = seg.get("words", [])
         repetitions = seg.get("repetitions", [])
         for rep in repetitions:
@@ -210,7 +236,7 @@ def repetition_feature(session_id, base_dir="session_data"):
     longest_rep = max(rep_lengths) if rep_lengths else 0
     avg_rep_len = sum(rep_lengths) / len(rep_lengths) if rep_lengths else 0
 
-    rep_feat = {
+    return {
         "Word Repetition Index": round(rep_weights / rep_count, 3) if rep_count > 0 else 0,
         "Repetition Density I": round(rep_count / total_words * 100, 3) if total_words > 0 else 0,
         "Repetition Density II": round(rep_count / total_duration * 60, 3) if total_duration > 0 else 0,
@@ -219,67 +245,38 @@ def repetition_feature(session_id, base_dir="session_data"):
         "Average Repetition Length": round(avg_rep_len, 3)
     }
 
-    if os.path.exists(feature_file):
-        with open(feature_file, "r", encoding="utf-8") as f:
-            feature_data = json.load(f)
-    else:
-        feature_data = {}
-
-    feature_data.setdefault("repetition", []).append(rep_feat)
-
-    with open(feature_file, "w", encoding="utf-8") as f:
-        json.dump(feature_data, f, indent=4, ensure_ascii=False)
-
-    print(f"[Done] Repetition features written to {feature_file}")
-
-
-
-def fillerword_feature(session_id, base_dir="session_data"):
-    json_file = os.path.join(base_dir, session_id, f"{session_id}_transcriptionCW.json")
-    feature_file = os.path.join(base_dir, session_id, f"{session_id}_feature.json")
-
-    if not os.path.exists(json_file):
-        print(f"[Error] transcriptionCW file not found: {json_file}")
+def repetition_feature(session_id, base_dir="session_data"):
+    session = _load_session(session_id, base_dir)
+    if session is None:
         return
+    feature_file = write_features(session_id, {"repetition": compute_repetition_feature(session)}, base_dir)
+    print(f"[Done] Repetition features written to {feature_file}")
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
 
-    segments = data.get("segments", [])
-    tgt_speaker = target_speaker(segments)
-    tgt_segments = [seg for seg in segments if seg.get("speaker") == tgt_speaker]
 
-    total_duration = sum(seg["end"] - seg["start"] for seg in tgt_segments)
-    total_words = sum(len(seg.get("words", [])) for seg in tgt_segments)
+def compute_fillerword_feature(session):
+    total_duration = session["total_duration"]
+    total_words = session["total_words"]
 
     filler_total = 0
     filler_durations = []
     filler_intervals = []
 
-    for seg in tgt_segments:
+    for seg, indices in zip(session["tgt_segments"], session["filler_indices"]):
         fillers = seg.get("fillerwords", [])
-        words = seg.get("words", [])
 
         filler_total += len(fillers)
         filler_durations += [fw["duration"] for fw in fillers]
 
-        if len(fillers) >= 2:
-            indices = []
-            for fw in fillers:
-                for i, w in enumerate(words):
-                    if abs(w.get("start", 0) - fw["start"]) < 0.01:
-                        indices.append(i)
-                        break
-            indices.sort()
-            intervals = [indices[i+1] - indices[i] - 1 for i in range(len(indices)-1)]
-            if intervals:
-                filler_intervals.append(sum(intervals) / len(intervals))
+        intervals = [indices[i+1] - indices[i] - 1 for i in range(len(indices)-1)]
+        if intervals:
+            filler_intervals.append(sum(intervals) / len(intervals))
 
     avg_duration = sum(filler_durations) / len(filler_durations) if filler_durations else 0
     longest_duration = max(filler_durations) if filler_durations else 0
     avg_interval = sum(filler_intervals) / len(filler_intervals) if filler_intervals else 0
 
-    feat = {
+    return {
         "Filler Word Density I": round(filler_total / total_words * 100, 3) if total_words > 0 else 0,
         "Filler Word Density II": round(filler_total / total_duration * 60, 3) if total_duration > 0 else 0,
         "Filler Word Proportion": round((sum(filler_durations) / total_duration) * 100, 3) if total_duration > 0 else 0,
@@ -288,43 +285,21 @@ def fillerword_feature(session_id, base_dir="session_data"):
         "Average Filler Word Interval": round(avg_interval, 3)
     }
 
-    if os.path.exists(feature_file):
-        with open(feature_file, "r", encoding="utf-8") as f:
-            feature_data = json.load(f)
-    else:
-        feature_data = {}
-
-    feature_data.setdefault("fillerword", []).append(feat)
-
-    with open(feature_file, "w", encoding="utf-8") as f:
-        json.dump(feature_data, f, indent=4, ensure_ascii=False)
-
-    print(f"[Done] Filler word features written to {feature_file}")
-
-
-def plm_feature(session_id, base_dir="session_data"):
-
-
-    json_file = os.path.join(base_dir, session_id, f"{session_id}_transcriptionCW.json")
-    feature_file = os.path.join(base_dir, session_id, f"{session_id}_feature.json")
-
-    if not os.path.exists(json_file):
-        print(f"[Error] transcriptionCW file not found: {json_file}")
+def fillerword_feature(session_id, base_dir="session_data"):
+    session = _load_session(session_id, base_dir)
+    if session is None:
         return
+    feature_file = write_features(session_id, {"fillerword": compute_fillerword_feature(session)}, base_dir)
+    print(f"[Done] Filler word features written to {feature_file}")
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    segments = data.get("segments", [])
-    tgt_speaker = target_speaker(segments)
-    tgt_segments = [seg for seg in segments if seg.get("speaker") == tgt_speaker]
 
-    sequence = ''.join(seg.get("mispronunciation", "") for seg in tgt_segments)
+def compute_plm_feature(session):
+    sequence = ''.join(seg.get("mispronunciation", "") for seg in session["tgt_segments"])
     sequence = re.sub(r"[^CE]", "", sequence.upper())
 
     n = len(sequence)
     if n == 0:
-        feat = {
+        return {
             "Mispronunciation Density": 0,
             "Normalized Transition Count": 0,
             "Average Common Correct": 0,
@@ -332,61 +307,68 @@ def plm_feature(session_id, base_dir="session_data"):
             "Longest Common Correct": 0,
             "Longest Common Error": 0
         }
-    else:
-        transitions = sum(1 for i in range(1, n) if sequence[i] != sequence[i - 1])
-        MPD = sum(1 for ch in sequence if ch == 'E') / n
-        NTC = transitions / n
-
-        def run_lengths(s, ch):
-            return [len(g) for g in re.findall(f"{ch}+", s)]
-
-        c_runs = run_lengths(sequence, 'C')
-        e_runs = run_lengths(sequence, 'E')
-
-        ACC = sum(c_runs) / len(c_runs) if c_runs else 0
-        ACE = sum(e_runs) / len(e_runs) if e_runs else 0
-        LCC = max(c_runs) if c_runs else 0
-        LCE = max(e_runs) if e_runs else 0
-
-        feat = {
-            "Mispronunciation Density": round(MPD, 3),
-            "Normalized Transition Count": round(NTC, 3),
-            "Average Common Correct": round(ACC, 3),
-            "Average Common Error": round(ACE, 3),
-            "Longest Common Correct": LCC,
-            "Longest Common Error": LCE
-        }
 
-    if os.path.exists(feature_file):
-        with open(feature_file, "r", encoding="utf-8") as f:
-            feature_data = json.load(f)
-    else:
-        feature_data = {}
+    transitions = sum(1 for i in range(1, n) if sequence[i] != sequence[i - 1])
+    MPD = sum(1 for ch in sequence if ch == 'E') / n
+    NTC = transitions / n
 
-    feature_data.setdefault("plm", []).append(feat)
+    def run_lengths(s, ch):
+        return [len(g) for g in re.findall(f"{ch}+", s)]
 
-    with open(feature_file, "w", encoding="utf-8") as f:
-        json.dump(feature_data, f, indent=4, ensure_ascii=False)
+    c_runs = run_lengths(sequence, 'C')
+    e_runs = run_lengths(sequence, 'E')
 
+    ACC = sum(c_runs) / len(c_runs) if c_runs else 0
+    ACE = sum(e_runs) / len(e_runs) if e_runs else 0
+    LCC = max(c_runs) if c_runs else 0
+    LCE = max(e_runs) if e_runs else 0
+
+    return {
+        "Mispronunciation Density": round(MPD, 3),
+        "Normalized Transition Count": round(NTC, 3),
+        "Average Common Correct": round(ACC, 3),
+        "Average Common Error": round(ACE, 3),
+        "Longest Common Correct": LCC,
+        "Longest Common Error": LCE
+    }
+
+def plm_feature(session_id, base_dir="session_data"):
+    session = _load_session(session_id, base_dir)
+    if session is None:
+        return
+    feature_file = write_features(session_id, {"plm": compute_plm_feature(session)}, base_dir)
     print(f"[Done] PLM features written to {feature_file}")
 
 
+FEATURE_GROUPS = {
+    "pause": compute_pause_feature,
+    "syllable": compute_syllable_feature,
+    "repetition": compute_repetition_feature,
+    "fillerword": compute_fillerword_feature,
+    "plm": compute_plm_feature,
+}
 
-def feature_extraction(session_id, base_dir="session_data"):
 
-    feature_file = os.path.join(base_dir, session_id, f"{session_id}_feature.json")
+def feature_extraction(session_id, base_dir="session_data", data=None, pause_threshold=None):
+    """Compute every feature group from one load of the transcript.
 
-    if not os.path.exists(feature_file):
-        with open(feature_file, "w", encoding="utf-8") as f:
-            json.dump({}, f, indent=4)
+    The groups are appended to {session_id}_feature.json in a single write and
+    also returned as a dict so callers don't need to read the file back.
+    With `pause_threshold`, pause features come from the session's gap index
+    rather than the pauses annotated on the transcript.
+    """
+    if data is None:
+        data = load_transcript(session_id, base_dir)
+        if data is None:
+            return
+    gap_index = load_gap_index(session_id, base_dir, data=data) if pause_threshold is not None else None
+    session = prepare_session(data, gap_index, pause_threshold)
 
-    pause_feature(session_id, base_dir=base_dir)
-    syllable_feature(session_id, base_dir=base_dir)
-    repetition_feature(session_id, base_dir=base_dir)
-    fillerword_feature(session_id, base_dir=base_dir)
-    plm_feature(session_id, base_dir=base_dir)
+    features = {group: compute(session) for group, compute in FEATURE_GROUPS.items()}
+    feature_file = write_features(session_id, features, base_dir)
 
-    print(f"[All Analysis Done] Feature extraction complete for session {session_id}")
+    print(f"[All Analysis Done] Feature extraction complete for session {session_id}: {feature_file}")
+    return features
 
 
 if __name__ == "__main__":
@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import atexit
+import signal
+import time
+import uuid
+import sqlite3
+import threading
+import traceback
+import multiprocessing
+from contextlib import closing
+
+JOB_DIR = os.getenv("SATE_JOB_DIR", "job_data")
+MAX_QUEUED = int(os.getenv("SATE_JOB_QUEUE_SIZE", "32"))
+POLL_INTERVAL = 1.0
+SUPERVISE_INTERVAL = 2.0
+# A job whose worker dies this many times is failed instead of requeued again.
+MAX_ATTEMPTS = 3
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """Bounded job queue persisted in SQLite so queued work survives restarts.
+
+    Status goes queued -> running -> done | failed; `stage` follows the
+    pipeline stage of a running job.
+    """
+
+    def __init__(self, job_dir=JOB_DIR, max_queued=MAX_QUEUED):
+        self.job_dir = job_dir
+        self.upload_dir = os.path.join(job_dir, "uploads")
+        self.db_path = os.path.join(job_dir, "jobs.sqlite3")
+        self.max_queued = max_queued
+        os.makedirs(self.upload_dir, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    params TEXT NOT NULL,
+                    audio_path TEXT NOT NULL,
+                    session_id TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            # Added after the first release; older job databases get them here.
+            for column in ("worker_pid INTEGER", "attempts INTEGER NOT NULL DEFAULT 0"):
+                try:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    pass  # already there (possibly added by another process just now)
+
+    def _connect(self):
+        # Autocommit mode; write transactions are opened explicitly with BEGIN IMMEDIATE.
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def new_upload_path(self, suffix):
+        job_id = uuid.uuid4().hex
+        return job_id, os.path.join(self.upload_dir, f"{job_id}{suffix}")
+
+    def submit(self, job_id, audio_path, params):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                conn.execute("ROLLBACK")
+                raise QueueFull(f"{queued} jobs already queued")
+            conn.execute(
+                "INSERT INTO jobs (id, status, stage, params, audio_path, created_at, updated_at) "
+                "VALUES (?, 'queued', NULL, ?, ?, ?, ?)",
+                (job_id, json.dumps(params), audio_path, now, now))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return job_id
+
+    def claim(self, worker_pid=None):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', stage = 'starting', worker_pid = ?, "
+                         "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                         (worker_pid, time.time(), row["id"]))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with closing(self._connect()) as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def set_stage(self, job_id, stage):
+        self._update(job_id, stage=stage)
+
+    def finish(self, job_id, session_id):
+        self._update(job_id, status="done", stage="done", session_id=session_id)
+
+    def fail(self, job_id, error):
+        self._update(job_id, status="failed", error=error)
+
+    def get(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        return job
+
+    def depth(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def requeue_running(self, worker_pid=None):
+        """Put jobs whose worker is gone back in the queue; returns how many were requeued.
+
+        Without `worker_pid` every running job is requeued (a previous server
+        process died). Jobs that already took down MAX_ATTEMPTS workers fail.
+        """
+        where, args = "status = 'running'", ()
+        if worker_pid is not None:
+            where, args = "status = 'running' AND worker_pid = ?", (worker_pid,)
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(f"UPDATE jobs SET status = 'failed', error = ?, updated_at = ? "
+                         f"WHERE {where} AND attempts >= ?",
+                         (f"Worker died {MAX_ATTEMPTS} times while running this job", now, *args, MAX_ATTEMPTS))
+            return conn.execute(f"UPDATE jobs SET status = 'queued', stage = NULL, worker_pid = NULL, "
+                                f"updated_at = ? WHERE {where}", (now, *args)).rowcount
+
+
+def worker_main(job_dir, gpu_budget_mb=None, cpu_budget_mb=None, warmup_device=None, cw_devices=None):
+    # Imported here so the server process does not pay for them at import time.
+    from cw_replicas import shutdown_replicas
+
+    # terminate() from the supervisor: exit normally so CrisperWhisper replica
+    # processes ("cpu*N") are shut down with this worker instead of orphaned.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        _worker_loop(job_dir, gpu_budget_mb, cpu_budget_mb, warmup_device, cw_devices)
+    finally:
+        shutdown_replicas()
+
+
+def _worker_loop(job_dir, gpu_budget_mb, cpu_budget_mb, warmup_device, cw_devices):
+    from model_pool import ModelPool, model_name
+    from pipeline import run_pipeline
+    from cw_replicas import warmup_replicas
+    from metrics import REQUESTS
+
+    queue = JobQueue(job_dir)
+    model_pool = ModelPool(gpu_budget_mb=gpu_budget_mb, cpu_budget_mb=cpu_budget_mb)
+    if warmup_device:
+        model_pool.warmup(warmup_device, names=[model_name("whisperx"), "align", "diarization"])
+        warmup_replicas(model_pool, cw_devices, model_name("crisperwhisper"))
+    print(f"[Worker {os.getpid()}] ready")
+
+    while True:
+        job = queue.claim(os.getpid())
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        job_id = job["id"]
+        params = job["params"]
+        print(f"[Worker {os.getpid()}] running job {job_id}")
+        try:
+            session_id, _ = run_pipeline(
+                job["audio_path"],
+                device=params.get("device", "cuda"),
+                pause_threshold=params.get("pause_threshold", 0.5),
+                num_speakers=params.get("num_speakers", 2),
+                model_pool=model_pool,
+                on_stage=lambda stage: queue.set_stage(job_id, stage),
+                window_seconds=params.get("window_seconds"),
+                cw_devices=cw_devices,
+                precision=params.get("precision"))
+            queue.finish(job_id, session_id)
+            REQUESTS.labels("worker", "ok").inc()
+        except Exception as e:
+            traceback.print_exc()
+            queue.fail(job_id, f"{type(e).__name__}: {e}")
+            REQUESTS.labels("worker", "error").inc()
+        finally:
+            try:
+                os.remove(job["audio_path"])
+            except OSError:
+                pass
+
+
+class WorkerSupervisor:
+    """Runs job worker processes and replaces any that die.
+
+    A dead worker's running job goes back to the queue (see
+    JobQueue.requeue_running) before a replacement is started.
+    """
+
+    def __init__(self, num_workers, job_dir=JOB_DIR, gpu_budget_mb=None, cpu_budget_mb=None, warmup_device=None,
+                 cw_devices=None):
+        self.num_workers = num_workers
+        self.queue = JobQueue(job_dir)
+        self.worker_args = (job_dir, gpu_budget_mb, cpu_budget_mb, warmup_device, cw_devices)
+        self.workers = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._supervise, daemon=True)
+
+    def _spawn(self):
+        # spawn, not fork: CUDA cannot be initialised again in a forked child.
+        # Not a daemon: daemonic processes may not start children, and "cpu*N"
+        # CrisperWhisper replicas are child processes. stop() reaps them instead.
+        proc = multiprocessing.get_context("spawn").Process(target=worker_main, args=self.worker_args)
+        proc.start()
+        return proc
+
+    def start(self):
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print(f"Requeued {requeued} interrupted jobs")
+        self.workers = [self._spawn() for _ in range(self.num_workers)]
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def check(self):
+        for i, proc in enumerate(self.workers):
+            if proc.is_alive():
+                continue
+            requeued = self.queue.requeue_running(worker_pid=proc.pid)
+            print(f"[Warning] Job worker {proc.pid} exited with code {proc.exitcode}; "
+                  f"requeued {requeued} job(s), starting a replacement")
+            self.workers[i] = self._spawn()
+
+    def _supervise(self):
+        while not self._stop.wait(SUPERVISE_INTERVAL):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    def alive(self):
+        return sum(proc.is_alive() for proc in self.workers)
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for proc in self.workers:
+            proc.terminate()
+        for proc in self.workers:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+
+
+def start_workers(num_workers, job_dir=JOB_DIR, gpu_budget_mb=None, cpu_budget_mb=None, warmup_device=None,
+                  cw_devices=None):
+    return WorkerSupervisor(num_workers, job_dir, gpu_budget_mb, cpu_budget_mb, warmup_device, cw_devices).start()
@@ -1,20 +1,73 @@
 import os
+import argparse
 import tempfile
 import json
-from flask import Flask, request, jsonify
+from contextlib import nullcontext
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from werkzeug.utils import secure_filename
 
-from preprocess import process_audio_file
-from pause import annotate_pauses
-from repetition import annotate_repetitions
-from syllable import annotate_syllables
-from fillerword import annotate_fillerwords
+from model_pool import ModelPool, PRECISION, PRECISIONS, model_name
+from cw_replicas import CW_DEVICES, warmup_replicas
+from preprocess import process_audio_file, iter_process_audio_file
+from annotation_engine import annotate_session, load_transcript, make_annotators, transcript_path
+from pipeline import run_pipeline, PROCESS_ANNOTATORS
+from job_queue import JOB_DIR, JobQueue, QueueFull, start_workers
+from response_encoding import encode_response, parse_fields, project
+from profiling import RequestProfiler, parse_profile_modes
+from metrics import REQUESTS, QUEUE_DEPTH, observe_pipeline, update_gpu_memory, render as render_metrics
 
 from annotation import annotate_transcript
 
 
 
 app = Flask(__name__)
+model_pool = ModelPool()
+# Recordings are processed in windows of this many seconds when set (bounded memory).
+WINDOW_SECONDS = float(os.getenv("SATE_WINDOW_SECONDS", "0")) or None
+# Created on first use so importing this module does not create job_data/.
+job_queue = None
+# WorkerSupervisor when started with --workers; /jobs is refused without it.
+job_workers = None
+
+def get_job_queue():
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(JOB_DIR)
+    return job_queue
+
+def form_window_seconds():
+    # window_seconds=0 turns windowing off for one request.
+    value = request.form.get('window_seconds')
+    return (float(value) or None) if value else WINDOW_SECONDS
+
+def form_precision():
+    # "int8" selects int8 WhisperX and quantized CrisperWhisper for this request.
+    return request.form.get('precision') or PRECISION
+
+def bad_precision(precision):
+    return jsonify({'error': f"Unknown precision {precision!r}, expected one of {', '.join(PRECISIONS)}"}), 400
+
+def request_outcome(status):
+    if status < 400:
+        return "ok"
+    # Client mistakes and a full job queue are refusals, not failures.
+    return "rejected" if status < 500 or status == 503 else "error"
+
+def requested_profile():
+    # profile=1 (form or query) or an X-Profile header; a mode list such as
+    # "sampling,torch" picks profilers (see profiling.PROFILE_MODES).
+    return parse_profile_modes(request.form.get('profile') or request.args.get('profile')
+                               or request.headers.get('X-Profile'))
+
+def requested_fields():
+    # fields= / include= (form or query) keep only those dotted paths of the
+    # transcript, e.g. fields=segments.text,segments.pauses,segments.fillerwords
+    return parse_fields(request.values.get('fields') or request.values.get('include'))
+
+def json_response(result, status=200):
+    accept_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    body, headers = encode_response(result, accept_gzip)
+    return Response(body, status=status, headers=headers)
 
 @app.route('/process_old', methods=['POST'])
 def process_audio_old():
@@ -29,13 +82,12 @@ def process_audio_old():
 
     app.logger.info(f"Processing audio file: {input_audio_file}")
 
-    session_id = process_audio_file(input_audio_file, num_speakers=num_speakers, device=device)
-    annotate_pauses(session_id, pause_threshold)
-    annotate_repetitions(session_id)
-    annotate_syllables(session_id)
-    annotate_fillerwords(session_id)
+    session_id = process_audio_file(input_audio_file, num_speakers=num_speakers, device=device,
+                                    model_pool=model_pool)
+    data = annotate_session(session_id, ["pauses", "repetitions", "syllables", "fillerwords"],
+                            pause_threshold=pause_threshold)
 
-    output_annotation = annotate_transcript(session_id)
+    output_annotation = annotate_transcript(session_id, data=data)
 
     result = {
         'session_id': session_id,
@@ -45,10 +97,34 @@ def process_audio_old():
 
 
 
+# /process/stream counts itself: its status is sent before the pipeline runs.
+METERED_ENDPOINTS = {"process_audio_old", "process_audio", "submit_job"}
+
+@app.after_request
+def count_request(response):
+    if request.endpoint in METERED_ENDPOINTS:
+        REQUESTS.labels(request.endpoint, request_outcome(response.status_code)).inc()
+        g.request_counted = True
+    return response
+
+@app.teardown_request
+def count_failed_request(exc):
+    # With exception propagation (debug mode) a failed request never reaches after_request.
+    if exc is not None and request.endpoint in METERED_ENDPOINTS and not g.get("request_counted"):
+        REQUESTS.labels(request.endpoint, "error").inc()
+
+
 @app.route('/process', methods=['POST'])
 def process_audio():
     if 'audio_file' not in request.files:
         return jsonify({'error': 'Missing audio file '}), 400
+    precision = form_precision()
+    if precision not in PRECISIONS:
+        return bad_precision(precision)
+    try:
+        profile_modes = requested_profile()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     audio_file = request.files['audio_file']
     filename = secure_filename(audio_file.filename)
     
@@ -63,20 +139,19 @@ def process_audio():
 
     app.logger.info(f"Processing uploaded audio: {audio_path}")
 
-    session_id = process_audio_file(audio_path, num_speakers=num_speakers, device=device)
-    annotate_pauses(session_id, pause_threshold)
-    annotate_repetitions(session_id)
-    # annotate_syllables(session_id)
-    annotate_fillerwords(session_id)
+    # Only a request that asks for it is profiled; otherwise nothing is set up.
+    profiler = RequestProfiler(profile_modes) if profile_modes else None
+    with profiler or nullcontext():
+        session_id, transcription = run_pipeline(audio_path, device=device, pause_threshold=pause_threshold,
+                                                 num_speakers=num_speakers, model_pool=model_pool,
+                                                 window_seconds=form_window_seconds(), cw_devices=CW_DEVICES,
+                                                 precision=precision,
+                                                 on_stage=profiler.mark_stage if profiler else None)
     # annotate_transcript(session_id)
 
 
-    json_path = f"session_data/{session_id}/{session_id}_transcriptionCW.json"
-    if not os.path.isfile(json_path):
-        return jsonify({'error': f"Annotation file {json_path} not found"}), 500
-
-    with open(json_path, 'r', encoding='utf-8') as f:
-        transcription = json.load(f)
+    if transcription is None:
+        return jsonify({'error': f"Annotation file {transcript_path(session_id)} not found"}), 500
 
 
     try:
@@ -84,8 +159,153 @@ def process_audio():
     except OSError:
         pass
 
-    return jsonify(transcription), 200
+    # Encoded from the in-memory result; the file on disk is not read back.
+    result = project(transcription, requested_fields())
+    if profiler:
+        result = {**result, 'profile': profiler.save(session_id)}
+    return json_response(result)
+
+
+@app.route('/process/stream', methods=['POST'])
+def process_audio_stream():
+    if 'audio_file' not in request.files:
+        return jsonify({'error': 'Missing audio file '}), 400
+    precision = form_precision()
+    if precision not in PRECISIONS:
+        return bad_precision(precision)
+    audio_file = request.files['audio_file']
+    filename = secure_filename(audio_file.filename)
+
+    suffix = os.path.splitext(filename)[1] or '.wav'
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        audio_path = tmp.name
+        audio_file.save(audio_path)
+
+    device = request.form.get('device', 'cuda')
+    pause_threshold = float(request.form.get('pause_threshold', 0.5))
+    num_speakers = int(request.form.get('num_speakers', 2))
+
+    app.logger.info(f"Streaming uploaded audio: {audio_path}")
+
+    window_seconds = form_window_seconds()
+
+    # Segment-local annotators run on each segment as soon as CrisperWhisper returns it.
+    annotators = make_annotators(PROCESS_ANNOTATORS, pause_threshold)
+
+    def generate():
+        try:
+            events = iter_process_audio_file(audio_path, num_speakers=num_speakers, device=device,
+                                             model_pool=model_pool, segment_annotators=annotators,
+                                             window_seconds=window_seconds, cw_devices=CW_DEVICES,
+                                             precision=precision)
+            for event, payload in observe_pipeline(events):
+                yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+            REQUESTS.labels("process_audio_stream", "ok").inc()
+        except Exception as e:
+            app.logger.exception("Streaming pipeline failed")
+            REQUESTS.labels("process_audio_stream", "error").inc()
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            try:
+                os.remove(audio_path)
+            except OSError:
+                pass
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    if 'audio_file' not in request.files:
+        return jsonify({'error': 'Missing audio file '}), 400
+    precision = form_precision()
+    if precision not in PRECISIONS:
+        return bad_precision(precision)
+    # Without a live worker the job would sit in the queue forever.
+    if job_workers is None or job_workers.alive() == 0:
+        return jsonify({'error': "No job workers are running (start the server with --workers)"}), 503
+    audio_file = request.files['audio_file']
+    filename = secure_filename(audio_file.filename)
+
+    suffix = os.path.splitext(filename)[1] or '.wav'
+    queue = get_job_queue()
+    job_id, audio_path = queue.new_upload_path(suffix)
+    audio_file.save(audio_path)
+
+    params = {
+        'device': request.form.get('device', 'cuda'),
+        'pause_threshold': float(request.form.get('pause_threshold', 0.5)),
+        'num_speakers': int(request.form.get('num_speakers', 2)),
+        'window_seconds': form_window_seconds(),
+        'precision': precision,
+    }
+    try:
+        queue.submit(job_id, audio_path, params)
+    except QueueFull as e:
+        os.remove(audio_path)
+        return jsonify({'error': f"Job queue is full ({e}), retry later"}), 503
+
+    app.logger.info(f"Queued job {job_id}: {audio_path}")
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': f"Unknown job {job_id}"}), 404
+
+    result = {
+        'job_id': job_id,
+        'status': job['status'],
+        'stage': job['stage'],
+        'session_id': job['session_id'],
+    }
+    if job['status'] == 'failed':
+        result['error'] = job['error']
+    if job['status'] == 'done':
+        result['result'] = project(load_transcript(job['session_id']), requested_fields())
+        return json_response(result)
+    return jsonify(result), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Gauges that are cheaper to read at scrape time than to keep current.
+    if job_workers is not None:
+        QUEUE_DEPTH.set(job_workers.queue.depth())
+    update_gpu_memory()
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=7860, debug=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--device", default="cuda", help="Device to warm up models on")
+    parser.add_argument("--gpu-budget-mb", type=float, default=None)
+    parser.add_argument("--cpu-budget-mb", type=float, default=None)
+    parser.add_argument("--no-warmup", action="store_true")
+    parser.add_argument("--cw-devices", default=CW_DEVICES,
+                        help='Devices for CrisperWhisper replicas, e.g. "cuda:0,cuda:1" or "cpu*4"')
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SATE_JOB_WORKERS", "0")),
+                        help="Worker processes running /jobs; each owns its own models")
+    args = parser.parse_args()
+    CW_DEVICES = args.cw_devices
+
+    if args.gpu_budget_mb is not None:
+        model_pool.budgets_mb["gpu"] = args.gpu_budget_mb
+    if args.cpu_budget_mb is not None:
+        model_pool.budgets_mb["cpu"] = args.cpu_budget_mb
+    if args.workers > 0:
+        job_workers = start_workers(args.workers, JOB_DIR, args.gpu_budget_mb, args.cpu_budget_mb,
+                                    warmup_device=None if args.no_warmup else args.device, cw_devices=CW_DEVICES)
+    # With job workers the models live in the workers; /process loads its own copy on demand.
+    elif not args.no_warmup:
+        model_pool.warmup(args.device, names=[model_name("whisperx"), "align", "diarization"])
+        warmup_replicas(model_pool, CW_DEVICES, model_name("crisperwhisper"))
+
+    # The reloader would start a second process with its own copy of every model.
+    app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
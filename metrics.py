@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    prometheus_client = None
+
+# Set PROMETHEUS_MULTIPROC_DIR (an empty directory) before start-up when job
+# workers run; /metrics then aggregates every process's samples.
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Stages run from well under a second (alignment) to many minutes (long recordings).
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class _NoopMetric:
+    """Stands in for every metric when prometheus_client is not installed."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+if prometheus_client is not None:
+    STAGE_SECONDS = Histogram("sate_stage_seconds", "Wall time of each pipeline stage", ["stage"],
+                              buckets=STAGE_BUCKETS)
+    SEGMENTS = Counter("sate_segments", "CrisperWhisper segments by outcome (transcribed/skipped)", ["outcome"])
+    REQUESTS = Counter("sate_requests", "Pipeline requests by endpoint and outcome", ["endpoint", "outcome"])
+    AUDIO_SECONDS = Counter("sate_audio_seconds", "Seconds of audio run through preprocessing")
+    QUEUE_DEPTH = Gauge("sate_queue_depth", "Jobs waiting in the job queue", multiprocess_mode="livemax")
+    GPU_MEMORY = Gauge("sate_gpu_memory_bytes", "GPU memory reserved by PyTorch", ["device"],
+                       multiprocess_mode="livesum")
+else:
+    STAGE_SECONDS = SEGMENTS = REQUESTS = AUDIO_SECONDS = QUEUE_DEPTH = GPU_MEMORY = _NoopMetric()
+
+
+def update_gpu_memory():
+    # Only when torch is already loaded: metrics alone should never import it.
+    torch = sys.modules.get("torch")
+    if prometheus_client is None or torch is None or not torch.cuda.is_available():
+        return
+    for i in range(torch.cuda.device_count()):
+        GPU_MEMORY.labels(f"cuda:{i}").set(torch.cuda.memory_reserved(i))
+
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def observe_pipeline(events):
+    """Pass iter_process_audio_file events through, timing stages and counting segments.
+
+    A stage lasts from its "stage" event to the next one (or "done"). A run
+    that stops early does not record its unfinished stage.
+    """
+    stage, started = None, 0.0
+    for event, payload in events:
+        now = time.perf_counter()
+        if event in ("stage", "done") and stage is not None:
+            STAGE_SECONDS.labels(stage).observe(now - started)
+            update_gpu_memory()
+            stage = None
+        if event == "stage":
+            stage, started = payload["stage"], now
+        elif event == "segment":
+            SEGMENTS.labels("transcribed").inc()
+        elif event == "skipped":
+            SEGMENTS.labels("skipped").inc()
+        elif event == "done":
+            AUDIO_SECONDS.inc(payload.get("audio_seconds", 0))
+        yield event, payload
+
+
+def render():
+    """(body, content type) for a /metrics response."""
+    if prometheus_client is None:
+        return b"# prometheus_client is not installed\n", "text/plain; charset=utf-8"
+    if MULTIPROC_DIR:
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
@@ -1,65 +1,280 @@
+import io
 import os
 import json
+import time
 import base64
+import hashlib
+import threading
 import requests
+import numpy as np
+import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from annotation_engine import load_transcript, save_transcript
+from result_cache import ResultCache
+from session_store import session_file
+from audio_io import SAMPLE_RATE, load_session_audio
+
+MAX_WORKERS = 4
+# The deployed API answers one {"ce": ...} per request, so batching is opt-in:
+# set this above 1 only for a service that returns one result per clip.
+MAX_BATCH_CLIPS = int(os.getenv("SATE_MISPRONUNCIATION_BATCH_CLIPS", "1"))
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+TIMEOUT_SECONDS = 120
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CACHE_MAX_BYTES = int(os.getenv("SATE_MISPRONUNCIATION_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+def wav_bytes_to_base64_url(wav_bytes):
+    b64_audio = base64.b64encode(wav_bytes).decode()
+    return f"data:audio/wav;base64,{b64_audio}"
 
 def wav_to_base64_url(wav_path):
     with open(wav_path, "rb") as f:
-        b64_audio = base64.b64encode(f.read()).decode()
-    return f"data:audio/wav;base64,{b64_audio}"
+        return wav_bytes_to_base64_url(f.read())
+
+class WavFileClip:
+    """A segment saved as its own WAV file (sessions from before the session audio store)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+
+    def wav_bytes(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def pcm16(self):
+        return sf.read(self.path, dtype="int16")
+
+class SampleClip:
+    """A segment as a slice of the memory-mapped session audio; encoded to WAV only when sent.
 
-def is_api_available(api_url):
+    `samples` may be int16 (the stored session audio, written as-is) or float.
+    """
+
+    def __init__(self, name, samples, sr=SAMPLE_RATE):
+        self.name = name
+        self.audio = samples
+        self.sr = sr
+        self.size = 44 + 2 * len(samples)  # 16-bit PCM WAV, as sf.write stores float data
+
+    def wav_bytes(self):
+        buf = io.BytesIO()
+        sf.write(buf, self.audio, self.sr, format="WAV")
+        return buf.getvalue()
+
+    def pcm16(self):
+        # The same libsndfile conversion wav_bytes() applies, without the header.
+        buf = io.BytesIO()
+        sf.write(buf, self.audio, self.sr, format="RAW", subtype="PCM_16")
+        return np.frombuffer(buf.getvalue(), dtype=np.int16), self.sr
+
+def as_clip(clip):
+    return WavFileClip(clip) if isinstance(clip, str) else clip
+
+def is_api_available(api_url, session=None):
     try:
-        response = requests.get(api_url)
+        response = (session or requests).get(api_url, timeout=TIMEOUT_SECONDS)
         return response.status_code < 500
     except Exception as e:
         print("[Error] Cannot reach API:", e)
         return False
 
-def annotate_mispronunciation(session_id, api_url="http://localhost:8080", base_dir="session_data"):
-    json_path = os.path.join(base_dir, session_id, f"{session_id}_transcriptionCW.json")
-    if not os.path.exists(json_path):
-        print(f"[Error] File not found: {json_path}")
+def pack_batches(clips, max_clips=MAX_BATCH_CLIPS, max_bytes=MAX_BATCH_BYTES):
+    # Consecutive clips per request, bounded by count and by base64-encoded size.
+    batches = []
+    current, current_bytes = [], 0
+    for clip in clips:
+        size = clip.size * 4 // 3
+        if current and (len(current) >= max_clips or current_bytes + size > max_bytes):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(clip)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+class MispronunciationClient:
+    """Client for /vocallens/api/analyze with connection reuse, batching and retries.
+
+    With max_batch_clips > 1 several clips go into one JSON list per request.
+    Batches are sent from a bounded thread pool over one keep-alive session.
+    Use get_client() so the session, and what was learned about batching,
+    outlive a single annotation run.
+    """
+
+    def __init__(self, api_url="http://localhost:8080", max_workers=MAX_WORKERS, max_batch_clips=MAX_BATCH_CLIPS,
+                 max_batch_bytes=MAX_BATCH_BYTES, max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS,
+                 timeout=TIMEOUT_SECONDS, session=None):
+        self.api_url = api_url.rstrip("/")
+        self.max_workers = max_workers
+        self.max_batch_clips = max_batch_clips
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # Set once the service answers a batch without one result per clip;
+        # from then on every clip is sent on its own.
+        self.per_clip_unsupported = False
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+    def is_available(self):
+        return is_api_available(self.api_url, self.session)
+
+    def _post(self, clips):
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = self.session.post(
+                    f"{self.api_url}/vocallens/api/analyze",
+                    headers={"Content-Type": "application/json"},
+                    data=json.dumps(clips),
+                    timeout=self.timeout
+                )
+                if resp.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return resp
+                reason = f"status {resp.status_code}"
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                reason = str(e)
+            delay = self.backoff * (2 ** attempt)
+            print(f"[Warning] Mispronunciation API {reason}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    @staticmethod
+    def _parse(result, n):
+        # One "ce" string per clip: a list of results, a list under "ce", or a
+        # single "ce" when only one clip was sent.
+        if isinstance(result, list) and len(result) == n:
+            return [item.get("ce", "") if isinstance(item, dict) else str(item) for item in result]
+        if isinstance(result, dict):
+            ce = result.get("ce", "")
+            if isinstance(ce, list) and len(ce) == n:
+                return [str(c) for c in ce]
+            if n == 1 and isinstance(ce, str):
+                return [ce]
+        return None
+
+    def analyze_batch(self, clips):
+        if len(clips) > 1 and self.per_clip_unsupported:
+            return [ce for clip in clips for ce in self.analyze_batch([clip])]
+        names = ", ".join(clip.name for clip in clips)
+        try:
+            resp = self._post([wav_bytes_to_base64_url(clip.wav_bytes()) for clip in clips])
+        except Exception as e:
+            print(f"[Error] Exception during API call for {names}:", e)
+            return [None] * len(clips)
+        if resp.status_code != 200:
+            print(f"[Warning] API error {resp.status_code} for {names}")
+            return [None] * len(clips)
+        try:
+            result = resp.json()
+        except ValueError as e:
+            print(f"[Warning] API returned invalid JSON for {names}: {e}")
+            return [None] * len(clips)
+        parsed = self._parse(result, len(clips))
+        if parsed is None and len(clips) > 1:
+            # The service did not answer per clip; fall back to one clip per request.
+            if not self.per_clip_unsupported:
+                print("[Warning] Mispronunciation API does not answer per clip, sending clips one at a time")
+            self.per_clip_unsupported = True
+            return [ce for clip in clips for ce in self.analyze_batch([clip])]
+        return parsed if parsed is not None else [None] * len(clips)
+
+    def analyze(self, clips):
+        """One "ce" string per clip (WAV path, WavFileClip or SampleClip), or None where the request failed."""
+        clips = [as_clip(clip) for clip in clips]
+        batches = pack_batches(clips, self.max_batch_clips, self.max_batch_bytes)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(self.analyze_batch, batches)
+        return [ce for batch in results for ce in batch]
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_url="http://localhost:8080"):
+    """The process-wide client for `api_url`."""
+    with _clients_lock:
+        if api_url not in _clients:
+            _clients[api_url] = MispronunciationClient(api_url)
+        return _clients[api_url]
+
+def segment_cache_key(clip, api_identity):
+    # Keyed on the 16-bit samples that are uploaded, not the file bytes, so a
+    # clip hits whether it comes from a WAV file or from the session audio.
+    samples, sr = as_clip(clip).pcm16()
+    digest = hashlib.sha256()
+    digest.update(api_identity.encode("utf-8"))
+    digest.update(str(sr).encode("ascii"))
+    digest.update(memoryview(np.ascontiguousarray(samples, dtype=np.int16)).cast("B"))
+    return digest.hexdigest()
+
+def annotate_mispronunciation(session_id, api_url="http://localhost:8080", base_dir="session_data", client=None,
+                              cache=None):
+    client = client or get_client(api_url)
+    cache = cache or ResultCache("mispronunciation", CACHE_MAX_BYTES)
+
+    data = load_transcript(session_id, base_dir)
+    if data is None:
         return
 
-    if not is_api_available(api_url):
-        print(f"[Error] API not available at {api_url}")
+    if not client.is_available():
+        print(f"[Error] API not available at {client.api_url}")
         return
 
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    session_audio = load_session_audio(session_id, base_dir)
 
-    segments = data.get("segments", [])
-    for segment in segments:
+    pending = []
+    for segment in data.get("segments", []):
         start = segment["start"]
         end = segment["end"]
         speaker = segment["speaker"]
         filename = f"{session_id}-{start:.2f}-{end:.2f}-{speaker}.wav"
-        filepath = os.path.join(base_dir, session_id, filename)
-        if not os.path.exists(filepath):
-            print(f"[Warning] Audio file missing: {filename}")
-            continue
+        if session_audio is not None and "start_sample" in segment:
+            # The stored samples themselves: a zero-copy view, uploaded without conversion.
+            clip = SampleClip(filename, session_audio.samples[segment["start_sample"]:segment["end_sample"]])
+        else:
+            filepath = session_file(session_id, filename, base_dir)
+            if not os.path.exists(filepath):
+                print(f"[Warning] Audio file missing: {filename} (run process_audio_file with save_segments=True)")
+                continue
+            clip = WavFileClip(filepath)
+        pending.append((segment, clip))
 
-        audio_url = wav_to_base64_url(filepath)
-        try:
-            resp = requests.post(
-                f"{api_url}/vocallens/api/analyze",
-                headers={"Content-Type": "application/json"},
-                data=json.dumps([audio_url])
-            )
-            if resp.status_code == 200:
-                result = resp.json()
-                segment["mispronunciation"] = result.get("ce", "")
-            else:
-                print(f"[Warning] API error {resp.status_code} for {filename}")
-                segment["mispronunciation"] = ""
-        except Exception as e:
-            print(f"[Error] Exception during API call for {filename}:", e)
+    api_identity = f"{client.api_url}/vocallens/api/analyze"
+    hits, misses = 0, []
+    for segment, clip in pending:
+        key = segment_cache_key(clip, api_identity)
+        ce = cache.get(key)
+        if ce is None:
+            misses.append((segment, clip, key))
+        else:
+            segment["mispronunciation"] = ce
+            hits += 1
+
+    results = client.analyze([clip for _, clip, _ in misses])
+    for (segment, _, key), ce in zip(misses, results):
+        if ce is None:
             segment["mispronunciation"] = ""
+            continue
+        segment["mispronunciation"] = ce
+        cache.put(key, ce)
+
+    data["mispronunciation_cache"] = {"hits": hits, "misses": len(misses)}
+    print(f"Mispronunciation cache: {hits} hits, {len(misses)} misses")
+
+    json_path = save_transcript(data, session_id, base_dir)
 
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
-    
     print(f"Session {session_id} mispronunciation annotation done: {json_path}")
     return data
 
@@ -0,0 +1,369 @@
+import os
+import gc
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from dotenv import load_dotenv
+load_dotenv()
+token = os.getenv("HF_TOKEN")
+
+WHISPERX_MODEL = "medium"
+CW_MODEL_ID = "nyrahealth/CrisperWhisper"
+WARMUP_SECONDS = 1.0
+SAMPLE_RATE = 16000
+# "int8" loads int8 WhisperX and a dynamically quantized CrisperWhisper (CPU).
+PRECISIONS = ("default", "int8")
+PRECISION = os.getenv("SATE_PRECISION", "default")
+# Converted models are kept here so the quantization only runs once.
+MODEL_CACHE_DIR = os.getenv("SATE_MODEL_CACHE_DIR", "models")
+
+
+def _env_budget(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+def memory_kind(device):
+    return "gpu" if str(device).startswith("cuda") else "cpu"
+
+
+def memory_device(device):
+    """The device a model's memory is charged to: "cpu" or an indexed "cuda:N"."""
+    device = str(device)
+    if memory_kind(device) == "cpu":
+        return "cpu"
+    if device == "cuda":
+        return f"cuda:{torch.cuda.current_device()}" if torch.cuda.is_available() else "cuda:0"
+    return device
+
+
+def memory_in_use(device):
+    if memory_kind(device) == "gpu":
+        if not torch.cuda.is_available():
+            return 0
+        free, total = torch.cuda.mem_get_info(torch.device(memory_device(device)))
+        return total - free
+    import psutil
+    return psutil.Process().memory_info().rss
+
+
+def _torch_modules(obj, depth=4, seen=None):
+    # Models come wrapped (Aligner, HF and pyannote pipelines); look a few
+    # attributes deep for the nn.Modules that hold the weights.
+    seen = set() if seen is None else seen
+    if id(obj) in seen or depth < 0:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, torch.nn.Module):
+        yield obj
+        return
+    if isinstance(obj, (list, tuple)):
+        children = obj
+    elif isinstance(obj, dict):
+        children = obj.values()
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        children = vars(obj).values()
+    else:
+        return
+    for child in children:
+        yield from _torch_modules(child, depth - 1, seen)
+
+
+def model_nbytes(model):
+    """Bytes of the weights and buffers in `model`, or None if it holds no torch modules.
+
+    state_dict() rather than parameters() so dynamically quantized layers,
+    whose packed int8 weights are not parameters, are counted too.
+    """
+    tensors = {}
+    for module in _torch_modules(model):
+        for tensor in module.state_dict(keep_vars=True).values():
+            if isinstance(tensor, torch.Tensor):
+                key = tensor.data_ptr() if not tensor.is_quantized else id(tensor)
+                tensors[key] = tensor.element_size() * tensor.nelement()
+    return sum(tensors.values()) if tensors else None
+
+
+class Aligner:
+    def __init__(self, model, metadata, device):
+        self.model = model
+        self.metadata = metadata
+        self.device = device
+
+    def __call__(self, segments, audio):
+        import whisperx
+        return whisperx.align(segments, self.model, self.metadata, audio, self.device,
+                              return_char_alignments=False)
+
+
+def load_whisperx(device):
+    import whisperx
+    # faster-whisper has no float16 kernels on CPU.
+    compute_type = "float16" if memory_kind(device) == "gpu" else "float32"
+    return whisperx.load_model(WHISPERX_MODEL, device, compute_type=compute_type, language="en")
+
+
+def load_whisperx_int8(device):
+    import whisperx
+    return whisperx.load_model(WHISPERX_MODEL, device, compute_type="int8", language="en")
+
+
+def load_align(device):
+    import whisperx
+    alignment_model, metadata = whisperx.load_align_model(language_code="en", device=device)
+    return Aligner(alignment_model, metadata, device)
+
+
+def load_diarization(device):
+    import whisperx
+    return whisperx.DiarizationPipeline(use_auth_token=token, device=device)
+
+
+def _crisperwhisper_pipeline(cw_model, device, torch_dtype):
+    from transformers import AutoProcessor, pipeline
+
+    processor = AutoProcessor.from_pretrained(CW_MODEL_ID, token=token)
+
+    return pipeline(
+        "automatic-speech-recognition",
+        model=cw_model,
+        tokenizer=processor.tokenizer,
+        feature_extractor=processor.feature_extractor,
+        chunk_length_s=30,
+        batch_size=4,
+        return_timestamps='word',
+        torch_dtype=torch_dtype,
+        device=device,
+        generate_kwargs={"language": "en"}
+    )
+
+
+def load_crisperwhisper(device):
+    from transformers import AutoModelForSpeechSeq2Seq
+
+    torch_dtype = torch.float16 if memory_kind(device) == "gpu" else torch.float32
+
+    """ Use local Crisper Whisper Model
+    local_model_dir = "./CrisperWhisper_local"
+
+    cw_model = AutoModelForSpeechSeq2Seq.from_pretrained(
+        local_model_dir,
+        torch_dtype=torch_dtype,
+        low_cpu_mem_usage=True,
+        use_safetensors=True
+    )
+    cw_model.to(device)
+
+    processor = AutoProcessor.from_pretrained(local_model_dir)
+
+    """
+    cw_model = AutoModelForSpeechSeq2Seq.from_pretrained(
+        CW_MODEL_ID,
+        torch_dtype=torch_dtype,
+        low_cpu_mem_usage=True,
+        use_safetensors=True,
+        token=token
+    )
+    cw_model.to(device)
+
+    return _crisperwhisper_pipeline(cw_model, device, torch_dtype)
+
+
+def quantized_cw_path(cache_dir=MODEL_CACHE_DIR):
+    import transformers
+    # Pickled modules are tied to the library versions that wrote them.
+    name = f"{CW_MODEL_ID.replace('/', '--')}-int8-torch{torch.__version__}-tf{transformers.__version__}.pt"
+    return os.path.join(cache_dir, name)
+
+
+def load_crisperwhisper_int8(device):
+    """CrisperWhisper with its Linear layers dynamically quantized to int8.
+
+    Dynamic quantization only runs on CPU; other devices get the normal model.
+    The quantized module is saved under MODEL_CACHE_DIR after the first
+    conversion and loaded from there afterwards.
+    """
+    if memory_kind(device) == "gpu":
+        print(f"[Warning] int8 CrisperWhisper runs on CPU only, loading the float16 model on {device}")
+        return load_crisperwhisper(device)
+
+    from transformers import AutoModelForSpeechSeq2Seq
+
+    path = quantized_cw_path()
+    if os.path.exists(path):
+        print(f"Loading quantized CrisperWhisper from {path}")
+        cw_model = torch.load(path, weights_only=False)
+    else:
+        cw_model = AutoModelForSpeechSeq2Seq.from_pretrained(
+            CW_MODEL_ID,
+            torch_dtype=torch.float32,
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
+            token=token
+        )
+        cw_model = torch.ao.quantization.quantize_dynamic(cw_model, {torch.nn.Linear}, dtype=torch.qint8)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(cw_model, tmp_path)
+        os.replace(tmp_path, path)
+        print(f"Quantized CrisperWhisper saved to: {path}")
+    cw_model.eval()
+
+    return _crisperwhisper_pipeline(cw_model, device, torch.float32)
+
+
+def _warmup_whisperx(model, audio):
+    model.transcribe(audio)
+
+
+def _warmup_align(aligner, audio):
+    aligner([{"start": 0.0, "end": WARMUP_SECONDS, "text": "hello"}], audio)
+
+
+def _warmup_diarization(diarization_model, audio):
+    diarization_model(audio)
+
+
+def _warmup_crisperwhisper(asr_pipeline, audio):
+    asr_pipeline({"raw": audio, "sampling_rate": SAMPLE_RATE})
+
+
+LOADERS = {
+    "whisperx": load_whisperx,
+    "align": load_align,
+    "diarization": load_diarization,
+    "crisperwhisper": load_crisperwhisper,
+    "whisperx@int8": load_whisperx_int8,
+    "crisperwhisper@int8": load_crisperwhisper_int8,
+}
+
+WARMUPS = {
+    "whisperx": _warmup_whisperx,
+    "align": _warmup_align,
+    "diarization": _warmup_diarization,
+    "crisperwhisper": _warmup_crisperwhisper,
+    "whisperx@int8": _warmup_whisperx,
+    "crisperwhisper@int8": _warmup_crisperwhisper,
+}
+
+
+def model_name(name, precision=None):
+    """Pool name of a model at a precision: "whisperx" -> "whisperx@int8" when quantized."""
+    precision = precision or PRECISION
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    variant = f"{name}@{precision}"
+    return variant if variant in LOADERS else name
+
+
+def default_cw_device():
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def compute_dtypes(device, cw_devices, precision=None):
+    """What WhisperX and each CrisperWhisper replica compute in, as the loaders choose it."""
+    int8 = (precision or PRECISION) == "int8"
+    gpu = memory_kind(device) == "gpu"
+    # int8 CrisperWhisper falls back to float16 on a GPU (load_crisperwhisper_int8).
+    cw_dtype = {"gpu": "float16", "cpu": "int8" if int8 else "float32"}
+    return {
+        "whisperx": "int8" if int8 else "float16" if gpu else "float32",
+        "crisperwhisper": sorted({cw_dtype[memory_kind(cw_device)] for cw_device in cw_devices}),
+    }
+
+
+class ModelPool:
+    """Keeps loaded models resident across requests.
+
+    Models are keyed by (name, device). Every device has its own optional
+    budget in MB: budgets_mb["cuda:1"] (or "cpu") if set, else the budget for
+    its kind, budgets_mb["gpu"] / budgets_mb["cpu"]. When a load pushes a
+    device over budget the least recently used models on that device are
+    evicted.
+    """
+
+    def __init__(self, gpu_budget_mb=None, cpu_budget_mb=None, loaders=None, warmups=None):
+        self.budgets_mb = {
+            "gpu": gpu_budget_mb if gpu_budget_mb is not None else _env_budget("SATE_GPU_BUDGET_MB"),
+            "cpu": cpu_budget_mb if cpu_budget_mb is not None else _env_budget("SATE_CPU_BUDGET_MB"),
+        }
+        self.loaders = dict(LOADERS, **(loaders or {}))
+        self.warmups = dict(WARMUPS, **(warmups or {}))
+        self._models = OrderedDict()
+        self._sizes_mb = {}
+        self._lock = threading.RLock()
+
+    def get(self, name, device):
+        key = (name, str(device))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+            if key in self._sizes_mb:
+                self._evict_for(device, self._sizes_mb[key], keep=key)
+
+            print(f"Loading {name} model on {device}...")
+            before = memory_in_use(device)
+            model = self.loaders[name](device)
+            size = model_nbytes(model)
+            if size is None:
+                # Not a torch model (WhisperX runs on CTranslate2): fall back to
+                # what the device gained during the load.
+                size = max(memory_in_use(device) - before, 0)
+            self._sizes_mb[key] = size / (1024 * 1024)
+            self._models[key] = model
+            self._evict_for(device, 0, keep=key)
+            return model
+
+    def budget_mb(self, device):
+        device = memory_device(device)
+        budget = self.budgets_mb.get(device)
+        return budget if budget is not None else self.budgets_mb.get(memory_kind(device))
+
+    def usage_mb(self, device):
+        device = memory_device(device)
+        return sum(self._sizes_mb[key] for key in self._models if memory_device(key[1]) == device)
+
+    def _evict_for(self, device, incoming_mb, keep=None):
+        budget = self.budget_mb(device)
+        if budget is None:
+            return
+        device = memory_device(device)
+        for key in list(self._models):
+            if self.usage_mb(device) + incoming_mb <= budget:
+                break
+            if key == keep or memory_device(key[1]) != device:
+                continue
+            self.evict(*key)
+
+    def evict(self, name, device):
+        key = (name, str(device))
+        with self._lock:
+            model = self._models.pop(key, None)
+            if model is None:
+                return
+            print(f"Evicting {name} model from {device} ({self._sizes_mb.get(key, 0):.0f} MB)")
+            del model
+            gc.collect()
+            if memory_kind(device) == "gpu" and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._models):
+                self.evict(*key)
+
+    def warmup(self, device, names=None, cw_device=None):
+        audio = np.zeros(int(WARMUP_SECONDS * SAMPLE_RATE), dtype=np.float32)
+        for name in names or ["whisperx", "align", "diarization", "crisperwhisper"]:
+            is_cw = name.split("@")[0] == "crisperwhisper"
+            model_device = (cw_device or default_cw_device()) if is_cw else device
+            model = self.get(name, model_device)
+            try:
+                self.warmups[name](model, audio)
+            except Exception as e:
+                print(f"[Warning] Warmup failed for {name} on {model_device}: {e}")
@@ -1,41 +1,42 @@
-import os
-import json
+from annotation_engine import load_transcript, save_transcript
+from pause_index import load_gap_index, pauses_by_segment
+
+def annotate_segment_pauses(segment, threshold):
+    words = segment.get("words", [])
+    if "pauses" in segment:
+        del segment["pauses"]
+        
+    pauses = []
+    if words and len(words) > 1:
+        for i in range(1, len(words)):
+            prev_word = words[i - 1]
+            current_word = words[i]
+            gap = current_word["start"] - prev_word["end"]
+            if gap > threshold:
+                pause_info = {
+                    "start": round(prev_word["end"], 3),
+                    "end": round(current_word["start"], 3),
+                    "duration": round(gap, 3)
+                }
+                pauses.append(pause_info)
+    segment["pauses"] = pauses
+    return segment
 
 def annotate_pauses(session_id, threshold, base_dir="session_data"):
 
-    session_dir = os.path.join(base_dir, session_id)
-    json_file = os.path.join(session_dir, f"{session_id}_transcriptionCW.json")
-    
-    if not os.path.exists(json_file):
-        print(f"Error: could not finf {json_file}")
+    data = load_transcript(session_id, base_dir)
+    if data is None:
         return
     
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    
+    # The session's gap index answers any threshold without recomputing gaps.
     segments = data.get("segments", [])
-    for segment in segments:
-        words = segment.get("words", [])
+    index = load_gap_index(session_id, base_dir, data=data)
+    for segment, pauses in zip(segments, pauses_by_segment(index, threshold, len(segments))):
         if "pauses" in segment:
             del segment["pauses"]
-            
-        pauses = []
-        if words and len(words) > 1:
-            for i in range(1, len(words)):
-                prev_word = words[i - 1]
-                current_word = words[i]
-                gap = current_word["start"] - prev_word["end"]
-                if gap > threshold:
-                    pause_info = {
-                        "start": round(prev_word["end"], 3),
-                        "end": round(current_word["start"], 3),
-                        "duration": round(gap, 3)
-                    }
-                    pauses.append(pause_info)
         segment["pauses"] = pauses
     
-    with open(json_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    json_file = save_transcript(data, session_id, base_dir)
     
     print(f"Session {session_id} pause annotation done: {json_file}")
     return data
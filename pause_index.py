@@ -0,0 +1,162 @@
+import os
+import hashlib
+
+import numpy as np
+
+from session_store import session_path
+from transcript_columnar import has_plain_times
+from annotation_engine import load_transcript_columns
+
+
+def gap_index_path(session_id, base_dir="session_data"):
+    return session_path(session_id, "_gaps.npz", base_dir)
+
+
+def timing_digest(n_words, word_start, word_end, speakers):
+    """Hash of everything the index is built from, to tell when it is stale."""
+    digest = hashlib.sha256()
+    for array in (np.asarray(n_words, dtype=np.int64), np.asarray(word_start, dtype=np.float64),
+                  np.asarray(word_end, dtype=np.float64)):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update("\0".join(str(speaker) for speaker in speakers).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _data_digest(data):
+    segments = data.get("segments", [])
+    words = [word for seg in segments for word in seg.get("words", [])]
+    return timing_digest([len(seg.get("words", [])) for seg in segments],
+                         [word["start"] for word in words], [word["end"] for word in words],
+                         [str(seg.get("speaker") or "") for seg in segments])
+
+
+def build_gap_index(data):
+    """Every inter-word gap of a transcript, sorted by gap length.
+
+    Gaps are kept in transcript order as `position` so pauses above any
+    threshold can be returned in the same order annotate_pauses used.
+    """
+    prev_end, cur_start, seg_idx, word_idx = [], [], [], []
+    segments = data.get("segments", [])
+    for s, segment in enumerate(segments):
+        words = segment.get("words", [])
+        for i in range(1, len(words)):
+            prev_end.append(words[i - 1]["end"])
+            cur_start.append(words[i]["start"])
+            seg_idx.append(s)
+            word_idx.append(i)
+
+    prev_end = np.array(prev_end, dtype=np.float64)
+    cur_start = np.array(cur_start, dtype=np.float64)
+    gaps = cur_start - prev_end
+    order = np.argsort(gaps, kind="stable")
+    return {
+        "gaps": gaps[order],
+        # round() per value to match the Python rounding used in the JSON
+        "durations": np.array([round(float(g), 3) for g in gaps[order]], dtype=np.float64),
+        "position": order,
+        "prev_end": prev_end[order],
+        "cur_start": cur_start[order],
+        "segment": np.array(seg_idx, dtype=np.int64)[order],
+        "word": np.array(word_idx, dtype=np.int64)[order],
+        "segment_speaker": np.array([str(seg.get("speaker") or "") for seg in segments], dtype=str),
+        "n_words": np.array([len(seg.get("words", [])) for seg in segments], dtype=np.int64),
+        "digest": np.array(_data_digest(data)),
+    }
+
+
+def build_gap_index_from_columns(columns):
+    """build_gap_index straight from a columnar transcript (transcript_columnar.to_columns)."""
+    offsets = columns["segment_offsets"]
+    n_words = np.diff(offsets)
+    word_segment = np.repeat(np.arange(len(n_words)), n_words)
+    # A gap sits between every pair of neighbouring words of the same segment.
+    j = np.flatnonzero(word_segment[1:] == word_segment[:-1]) + 1
+    prev_end = columns["word_end"][j - 1]
+    cur_start = columns["word_start"][j]
+    gaps = cur_start - prev_end
+    order = np.argsort(gaps, kind="stable")
+    return {
+        "gaps": gaps[order],
+        "durations": np.array([round(float(g), 3) for g in gaps[order]], dtype=np.float64),
+        "position": order,
+        "prev_end": prev_end[order],
+        "cur_start": cur_start[order],
+        "segment": word_segment[j][order].astype(np.int64),
+        "word": (j - offsets[word_segment[j]])[order].astype(np.int64),
+        "segment_speaker": columns["segment_speaker"],
+        "n_words": n_words.astype(np.int64),
+        "digest": np.array(timing_digest(n_words, columns["word_start"], columns["word_end"],
+                                         columns["segment_speaker"])),
+    }
+
+
+def save_gap_index(index, session_id, base_dir="session_data"):
+    path = gap_index_path(session_id, base_dir)
+    np.savez(path, **index)
+    return path
+
+
+def _matches(index, data):
+    # Indexes written before the digest was stored are rebuilt once.
+    return "digest" in index and str(index["digest"]) == _data_digest(data)
+
+
+def load_gap_index(session_id, base_dir="session_data", data=None):
+    """Load the stored index; rebuild it from `data` if missing or stale."""
+    path = gap_index_path(session_id, base_dir)
+    if os.path.exists(path):
+        with np.load(path) as f:
+            index = {key: f[key] for key in f.files}
+        if data is None or _matches(index, data):
+            return index
+    if data is None:
+        # Columnar transcripts can be indexed without building the word dicts.
+        columns = load_transcript_columns(session_id, base_dir)
+        if columns is None or not has_plain_times(columns):
+            return None
+        index = build_gap_index_from_columns(columns)
+        save_gap_index(index, session_id, base_dir)
+        return index
+    index = build_gap_index(data)
+    save_gap_index(index, session_id, base_dir)
+    return index
+
+
+def _first_above(gaps, threshold):
+    return int(np.searchsorted(gaps, threshold, side="right"))
+
+
+def count_pauses_above(index, threshold):
+    return len(index["gaps"]) - _first_above(index["gaps"], threshold)
+
+
+def pauses_by_segment(index, threshold, n_segments):
+    """Pause lists for every segment, identical to annotate_segment_pauses."""
+    result = [[] for _ in range(n_segments)]
+    k = _first_above(index["gaps"], threshold)
+    for j in np.argsort(index["position"][k:], kind="stable") + k:
+        result[int(index["segment"][j])].append({
+            "start": round(float(index["prev_end"][j]), 3),
+            "end": round(float(index["cur_start"][j]), 3),
+            "duration": float(index["durations"][j])
+        })
+    return result
+
+
+def speaker_curve(index, speaker):
+    """Sorted gaps, pause durations and transcript positions for one speaker's segments."""
+    mask = index["segment_speaker"][index["segment"]] == speaker
+    return {"gaps": index["gaps"][mask], "durations": index["durations"][mask], "position": index["position"][mask]}
+
+
+def pause_stats(curve, threshold):
+    """(count, total duration, longest duration) of pauses longer than threshold."""
+    k = _first_above(curve["gaps"], threshold)
+    count = len(curve["gaps"]) - k
+    # Summed in transcript order, like the annotated pauses, so the rounded
+    # average comes out the same to the last digit.
+    total = float(sum(curve["durations"][k:][np.argsort(curve["position"][k:], kind="stable")].tolist()))
+    # Durations are sorted along with the gaps, so the last one is the longest.
+    longest = float(curve["durations"][-1]) if count else 0
+    return count, total, longest
@@ -0,0 +1,180 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: duplicates are only merged within one process.
+    fcntl = None
+
+from preprocess import process_audio_file
+from annotation_engine import annotate_session, load_transcript, save_transcript
+from model_pool import WHISPERX_MODEL, CW_MODEL_ID, compute_dtypes, memory_device
+from cw_replicas import resolve_cw_devices
+from result_cache import ResultCache
+from session_store import create_session, session_path, session_file
+
+PROCESS_ANNOTATORS = ["pauses", "repetitions", "fillerwords"]  # "syllables"
+
+# Bump when preprocessing changes in a way that makes stored transcripts stale.
+PIPELINE_CACHE_VERSION = 1
+PIPELINE_CACHE_ENTRIES_BYTES = int(os.getenv("SATE_PIPELINE_CACHE_BYTES", str(4 * 1024 * 1024)))
+
+SESSION_FILES = ["_transcription.txt", "_transcriptionCW.json", "_transcriptionCW.npz", "_gaps.npz"]
+# Written by later annotators from the source session's run; a clone starts without them.
+CLONE_DROPPED_FIELDS = ["mispronunciation_cache"]
+CLONE_DROPPED_SEGMENT_FIELDS = ["mispronunciation"]
+# Never rewritten after preprocessing, so sessions can share one copy on disk.
+SHARED_SESSION_FILES = ["_audio.npy"]
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def pipeline_cache_key(audio_path, num_speakers, window_seconds=None, precision=None, device="cuda",
+                       cw_devices=None):
+    # Pause threshold is left out: annotations are recomputed on every request.
+    # Devices and dtypes are in: a float16 GPU run and a CPU run transcribe differently.
+    digest = hashlib.sha256()
+    with open(audio_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    cw_devices = resolve_cw_devices(cw_devices)
+    params = {
+        "version": PIPELINE_CACHE_VERSION,
+        "num_speakers": num_speakers,
+        "whisperx_model": WHISPERX_MODEL,
+        "cw_model": CW_MODEL_ID,
+        "window_seconds": window_seconds,
+        "device": memory_device(device),
+        "cw_devices": cw_devices,
+        "dtypes": compute_dtypes(device, cw_devices, precision),
+    }
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _drop_clone_fields(session_id, base_dir):
+    data = load_transcript(session_id, base_dir)
+    if data is None:
+        return
+    dropped = [data.pop(field) for field in CLONE_DROPPED_FIELDS if field in data]
+    for segment in data.get("segments", []):
+        dropped += [segment.pop(field) for field in CLONE_DROPPED_SEGMENT_FIELDS if field in segment]
+    if dropped:
+        save_transcript(data, session_id, base_dir)
+
+
+def clone_session(source_id, base_dir="session_data"):
+    """Copy a finished session's files into a new session; returns the new id, or None."""
+    if not any(os.path.isfile(session_path(source_id, suffix, base_dir))
+               for suffix in ("_transcriptionCW.json", "_transcriptionCW.npz")):
+        return None
+    session_id, target_dir = create_session(base_dir)
+    # Only what preprocessing wrote; features and other later outputs are recomputed.
+    for suffix in SESSION_FILES:
+        source = session_path(source_id, suffix, base_dir)
+        if os.path.exists(source):
+            shutil.copy2(source, session_path(session_id, suffix, base_dir))
+    for suffix in SHARED_SESSION_FILES:
+        source = session_path(source_id, suffix, base_dir)
+        if os.path.exists(source):
+            try:
+                os.link(source, session_path(session_id, suffix, base_dir))
+            except OSError:
+                shutil.copy2(source, session_path(session_id, suffix, base_dir))
+    skipped = session_file(source_id, "skipped_segments.txt", base_dir)
+    if os.path.exists(skipped):
+        shutil.copy2(skipped, os.path.join(target_dir, "skipped_segments.txt"))
+    _drop_clone_fields(session_id, base_dir)
+    return session_id
+
+
+class _Inflight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = 0
+
+
+def _lock_file(path):
+    # The holder removes the lock file on release; a waiter that locked the
+    # removed file tries again on the new one.
+    while True:
+        f = open(path, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def _acquire(key, lock_dir):
+    """Hold `key` against other threads, then against other processes (job workers).
+
+    The thread lock comes first, so threads of one process queue on it
+    instead of each holding a lock file open.
+    """
+    with _inflight_lock:
+        entry = _inflight.setdefault(key, _Inflight())
+        entry.waiters += 1
+    entry.lock.acquire()
+    entry.file = None
+    if fcntl is not None:
+        try:
+            os.makedirs(lock_dir, exist_ok=True)
+            entry.file = _lock_file(os.path.join(lock_dir, f"{key}.lock"))
+        except BaseException:
+            _release(key, entry)
+            raise
+    return entry
+
+
+def _release(key, entry):
+    if entry.file is not None:
+        os.remove(entry.file.name)
+        fcntl.flock(entry.file, fcntl.LOCK_UN)
+        entry.file.close()
+        entry.file = None
+    entry.lock.release()
+    with _inflight_lock:
+        entry.waiters -= 1
+        if entry.waiters == 0:
+            del _inflight[key]
+
+
+def run_pipeline(audio_path, device="cuda", pause_threshold=0.5, num_speakers=2, model_pool=None,
+                 on_stage=None, cache=None, window_seconds=None, cw_devices=None, precision=None):
+    """Transcribe and annotate one recording the way /process does; returns (session_id, transcript).
+
+    Uploads already transcribed with the same parameters reuse a copy of the
+    earlier session and only rerun the annotators. Identical uploads arriving
+    at the same time, in this process or in another job worker, wait for the
+    first one and share its run.
+    """
+    on_stage = on_stage or (lambda stage: None)
+    cache = cache or ResultCache("pipeline", PIPELINE_CACHE_ENTRIES_BYTES)
+    key = pipeline_cache_key(audio_path, num_speakers, window_seconds, precision, device, cw_devices)
+
+    entry = _acquire(key, os.path.join(os.path.dirname(cache.path), "locks"))
+    try:
+        source_id = cache.get(key)
+        session_id = clone_session(source_id) if source_id else None
+        if session_id:
+            print(f"[Cache] {audio_path} matches session {source_id}, reusing it as session {session_id}")
+            on_stage("cached")
+        else:
+            session_id = process_audio_file(audio_path, num_speakers=num_speakers, device=device,
+                                            model_pool=model_pool, on_stage=on_stage,
+                                            window_seconds=window_seconds, cw_devices=cw_devices,
+                                            precision=precision)
+            cache.put(key, session_id)
+    finally:
+        _release(key, entry)
+
+    on_stage("annotation")
+    data = annotate_session(session_id, PROCESS_ANNOTATORS, pause_threshold=pause_threshold)
+    return session_id, data
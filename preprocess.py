@@ -1,257 +1,278 @@
 import os
-import json
 from pathlib import Path
-import whisperx
 import soundfile as sf
-import numpy as np
-import re
-import torch
-from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
-import sys
 
-from dotenv import load_dotenv
-load_dotenv()
-token = os.getenv("HF_TOKEN")
+from audio_io import (SAMPLE_RATE, decode_audio, probe_duration, slice_seconds, seconds_to_sample,
+                      save_session_audio, SessionAudioWriter)
+from model_pool import ModelPool, model_name
+from metrics import observe_pipeline
+from cw_replicas import resolve_cw_devices, iter_transcribe_replicas
+from annotation_engine import annotate_segment, save_transcript
+from speaker_assignment import assign_speakers
+from pause_index import build_gap_index, save_gap_index
+from session_store import create_session
+from windowing import WINDOW_OVERLAP, plan_windows, shift_segment, owned_segments, diarization_turns, match_speakers
 
 print("Start Preprocessing ... ...")
 
-sys.path.append('./CrisperWhisper/')
-from utils import adjust_pauses_for_hf_pipeline_output
+def segment_filename(session_id, start_time, end_time, speaker):
+    # Named after the rounded times stored in the transcript so that
+    # mispronunciation.py can find the file again from the JSON.
+    return f"{session_id}-{round(start_time, 3):.2f}-{round(end_time, 3):.2f}-{speaker}.wav"
 
-def generate_session_id():
-    session_root = "session_data"
-    if not os.path.exists(session_root):
-        os.makedirs(session_root)
-        return "000001"
-    
-    existing_ids = [d for d in os.listdir(session_root)
-                    if os.path.isdir(os.path.join(session_root, d)) and d.isdigit()]
-    if existing_ids:
-        new_id = max(int(x) for x in existing_ids) + 1
-    else:
-        new_id = 1
-    return f"{new_id:06d}"
-
-def assign_speakers(segments, diarization_segments):
-    speaker_map = {}
+def save_segment_wavs(segments_audio, session_id, session_dir, native=None, offset=0.0):
+    # 16 kHz clips from the shared buffer, or native-rate clips when `native` is given.
+    # `offset` is where `native` starts in the recording (windowed mode).
+    for seg in segments_audio:
+        segment_filepath = os.path.join(
+            session_dir, segment_filename(session_id, seg["start"], seg["end"], seg["speaker"]))
+        if native is None:
+            sf.write(segment_filepath, seg["audio"], SAMPLE_RATE)
+        else:
+            data, sr = native
+            sf.write(segment_filepath, slice_seconds(data, sr, seg["start"] - offset, seg["end"] - offset), sr)
+        print(f"Saved segment: {segment_filepath}")
+
+def label_speakers(segments, diarization_segments):
+    speaker_map = assign_speakers(segments, diarization_segments)
     for segment in segments:
-        segment_start = segment["start"]
-        segment_end = segment["end"]
-        max_overlap = 0
-        assigned_speaker = "Unknown"
-        
-        for _, diar in diarization_segments.iterrows():
-            speaker = diar["speaker"]
-            diar_start = diar["start"]
-            diar_end = diar["end"]
-            overlap_start = max(segment_start, diar_start)
-            overlap_end = min(segment_end, diar_end)
-            overlap_duration = max(0, overlap_end - overlap_start)
-            if overlap_duration > max_overlap:
-                max_overlap = overlap_duration
-                assigned_speaker = speaker
-        
-        speaker_map[segment_start] = assigned_speaker
-    return speaker_map
-
-def load_audio_for_split(input_audio_file):
-
-    if input_audio_file.lower().endswith('.mp3'):
-        from pydub import AudioSegment
-        audio_seg = AudioSegment.from_file(input_audio_file)
-        sr = audio_seg.frame_rate
-        samples = np.array(audio_seg.get_array_of_samples()).astype(np.float32)
-        samples = samples / 32768.0
-        if audio_seg.channels > 1:
-            samples = samples.reshape((-1, audio_seg.channels))
-        return samples, sr
-    else:
-        return sf.read(input_audio_file)
-
-def process_audio_file(input_audio_file, num_speakers, device="cuda"):
+        segment["speaker"] = speaker_map.get(segment["start"], "Unknown")
+        segment.pop("chars", None)
+
+def cut_segments(segments, audio, session_id, offset=0.0):
+    # Segments are sliced straight out of the 16 kHz ASR audio and handed to
+    # CrisperWhisper in memory; start_sample/end_sample locate them in the
+    # stored session audio. WAV files are only written when asked for.
+    return [{
+        "start": segment["start"],
+        "end": segment["end"],
+        "start_sample": seconds_to_sample(segment["start"]),
+        "end_sample": seconds_to_sample(segment["end"]),
+        "speaker": segment["speaker"],
+        "name": segment_filename(session_id, segment["start"], segment["end"], segment["speaker"]),
+        "audio": slice_seconds(audio, SAMPLE_RATE, segment["start"] - offset, segment["end"] - offset)
+    } for segment in segments]
+
+def write_transcript_lines(f, segments):
+    for segment in segments:
+        f.write(f"[{segment['start']} - {segment['end']}] (Speaker {segment['speaker']}): {segment['text']}\n")
+
+def iter_crisperwhisper(model_pool, cw_devices, cw_name, segments_audio, segments_cw, skipped_segments,
+                        segment_annotators):
+    for seg, entry in iter_transcribe_replicas(model_pool, segments_audio, cw_devices, cw_name):
+        if entry is None:
+            skipped_segments.append(seg["name"])
+            yield "skipped", {"segment": seg["name"]}
+            continue
+        if segment_annotators:
+            annotate_segment(entry, segment_annotators)
+        segments_cw.append(entry)
+        yield "segment", {"segment": entry}
+
+def write_session_outputs(session_id, session_dir, segments_cw, skipped_segments):
+    segments_cw = sorted(segments_cw, key=lambda x: x["start"])
+    cw_json_path = save_transcript({"segments": segments_cw}, session_id)
+    print(f"CrisperWhisper transcription saved to: {cw_json_path}")
+    save_gap_index(build_gap_index({"segments": segments_cw}), session_id)
     
+    if skipped_segments:
+        skipped_file = os.path.join(session_dir, "skipped_segments.txt")
+        with open(skipped_file, "w", encoding="utf-8") as f:
+            for s in sorted(skipped_segments):
+                f.write(s + "\n")
+        print(f"Skipped segments recorded in: {skipped_file}")
+
+def iter_process_audio_file(input_audio_file, num_speakers, device="cuda", model_pool=None, save_segments=False,
+                            segment_annotators=None, full_quality_segments=False, window_seconds=None,
+                            window_overlap=WINDOW_OVERLAP, cw_devices=None, precision=None):
+    """Run the preprocessing pipeline, yielding (event, payload) as work completes.
+
+    Events: "stage" as each stage starts, "transcription" and "diarization"
+    with the WhisperX segments, "session" once the session exists, then
+    "segment" / "skipped" per CrisperWhisper segment and finally "done".
+    `segment_annotators` (see annotation_engine.make_annotators) run on each
+    segment as soon as its words exist. The input is decoded once; saved
+    segment WAVs are 16 kHz unless `full_quality_segments` asks for the
+    original rate and channels. With `window_seconds` the recording is
+    processed in overlapping windows (see iter_process_windows).
+    `cw_devices` lists the devices CrisperWhisper replicas run on, e.g.
+    "cuda:0,cuda:1" or "cpu*4" (see cw_replicas); default SATE_CW_DEVICES.
+    `precision="int8"` uses int8 WhisperX and a quantized CrisperWhisper
+    (default SATE_PRECISION).
+    """
+
+    # Without a shared pool, models only live for this call (the old behaviour).
+    own_pool = model_pool is None
+    if own_pool:
+        model_pool = ModelPool()
+    cw_devices = resolve_cw_devices(cw_devices)
+    whisperx_name, cw_name = model_name("whisperx", precision), model_name("crisperwhisper", precision)
+
+    if window_seconds:
+        yield from iter_process_windows(input_audio_file, num_speakers, model_pool, device, save_segments,
+                                        segment_annotators, full_quality_segments, window_seconds, window_overlap,
+                                        cw_devices, whisperx_name, cw_name)
+        if own_pool:
+            model_pool.clear()
+        return
+
     print("Loading WhisperX model (English)...")
-    model = whisperx.load_model("medium", device, language="en")
+    # Its own stage, so a cold load is timed instead of falling before the first stage.
+    yield "stage", {"stage": "load"}
+    model = model_pool.get(whisperx_name, device)
     
-    audio = whisperx.load_audio(input_audio_file)
+    yield "stage", {"stage": "decode"}
+    audio, native = decode_audio(input_audio_file, keep_native=save_segments and full_quality_segments)
+    audio_seconds = len(audio) / SAMPLE_RATE
     
     print("Transcribing audio with WhisperX...")
+    yield "stage", {"stage": "transcription"}
     result = model.transcribe(audio)
+    yield "transcription", {"segments": [
+        {"start": seg["start"], "end": seg["end"], "text": seg["text"]} for seg in result["segments"]]}
     
     print("Performing forced alignment with WhisperX...")
-    alignment_model, metadata = whisperx.load_align_model(language_code="en", device=device)
-    result_aligned = whisperx.align(result["segments"], alignment_model, metadata, audio, device, return_char_alignments=True)
+    yield "stage", {"stage": "alignment"}
+    aligner = model_pool.get("align", device)
+    result_aligned = aligner(result["segments"], audio)
     
     print("Detecting speakers with WhisperX...")
-    diarization_model = whisperx.DiarizationPipeline(use_auth_token=token,
-                                                     device=device)
+    yield "stage", {"stage": "diarization"}
+    diarization_model = model_pool.get("diarization", device)
     diarization_segments = diarization_model(audio)
     
-    speaker_map = assign_speakers(result_aligned["segments"], diarization_segments)
-    for segment in result_aligned["segments"]:
-        segment["speaker"] = speaker_map.get(segment["start"], "Unknown")
-        segment.pop("chars", None)
+    label_speakers(result_aligned["segments"], diarization_segments)
+    yield "diarization", {"segments": [
+        {"start": seg["start"], "end": seg["end"], "speaker": seg["speaker"], "text": seg["text"]}
+        for seg in result_aligned["segments"]]}
 
-    session_id = generate_session_id()
-    session_dir = os.path.join("session_data", session_id)
-    os.makedirs(session_dir, exist_ok=True)
-    
-    data, sr = load_audio_for_split(input_audio_file)
-    
-    for segment in result_aligned["segments"]:
-        start_time = segment["start"]
-        end_time = segment["end"]
-        speaker = segment["speaker"]
-        start_sample = int(start_time * sr)
-        end_sample = int(end_time * sr)
-        segment_audio = data[start_sample:end_sample]
-        
-        segment_filename = f"{session_id}-{start_time:.2f}-{end_time:.2f}-{speaker}.wav"
-        segment_filepath = os.path.join(session_dir, segment_filename)
-        sf.write(segment_filepath, segment_audio, sr)
-        print(f"Saved segment: {segment_filepath}")
-    
+    session_id, session_dir = create_session()
+    save_session_audio(audio, session_id)
+    yield "session", {"session_id": session_id}
+
+    segments_audio = cut_segments(result_aligned["segments"], audio, session_id)
+
+    if save_segments:
+        save_segment_wavs(segments_audio, session_id, session_dir, native)
+    native = None
 
     transcript_path = os.path.join(session_dir, f"{session_id}_transcription.txt")
     with open(transcript_path, "w", encoding="utf-8") as f:
-        for segment in result_aligned["segments"]:
-            f.write(f"[{segment['start']} - {segment['end']}] (Speaker {segment['speaker']}): {segment['text']}\n")
+        write_transcript_lines(f, result_aligned["segments"])
     
 
-    del model
-    torch.cuda.empty_cache()
-    
+    del model, aligner, diarization_model, result, result_aligned
+    if own_pool:
+        model_pool.clear()
 
     print("Loading CrisperWhisper model...")
-    device_str = "cuda:0" if torch.cuda.is_available() else "cpu"
-    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-
-    """ Use local Crisper Whisper Model
-    local_model_dir = "./CrisperWhisper_local"
-
-    cw_model = AutoModelForSpeechSeq2Seq.from_pretrained(
-        local_model_dir,
-        torch_dtype=torch_dtype,
-        low_cpu_mem_usage=True,
-        use_safetensors=True
-    )
-    cw_model.to(device_str)
-    
-    processor = AutoProcessor.from_pretrained(local_model_dir)
+    yield "stage", {"stage": "crisperwhisper"}
+    segments_cw = []
+    skipped_segments = []
+    yield from iter_crisperwhisper(model_pool, cw_devices, cw_name, segments_audio, segments_cw, skipped_segments,
+                                   segment_annotators)
+    yield "stage", {"stage": "saving"}
+    write_session_outputs(session_id, session_dir, segments_cw, skipped_segments)
+
+    if own_pool:
+        model_pool.clear()
     
-    """
-    hf_model_id = "nyrahealth/CrisperWhisper"
+    yield "done", {"session_id": session_id, "segments": len(segments_cw), "skipped": len(skipped_segments),
+                   "audio_seconds": audio_seconds}
 
-    cw_model = AutoModelForSpeechSeq2Seq.from_pretrained(
-        hf_model_id,
-        torch_dtype=torch_dtype,
-        low_cpu_mem_usage=True,
-        use_safetensors=True,
-        token=token
-    )
-    cw_model.to(device_str)
+def iter_process_windows(input_audio_file, num_speakers, model_pool, device, save_segments, segment_annotators,
+                         full_quality_segments, window_seconds, window_overlap, cw_devices,
+                         whisperx_name="whisperx", cw_name="crisperwhisper"):
+    """Bounded-memory variant of iter_process_audio_file for long recordings.
 
-    processor = AutoProcessor.from_pretrained(hf_model_id, token=token)
+    Each window is decoded on its own and goes through WhisperX, diarization
+    and CrisperWhisper before the next one, so audio in memory is bounded by
+    the window length. Windows overlap; a segment belongs to the window that
+    owns its midpoint, and each window's speaker labels are matched to the
+    previous window's by who speaks when inside the overlap (num_speakers caps
+    how many distinct labels this creates). All models stay loaded for the
+    whole recording.
+    """
+    total_seconds = probe_duration(input_audio_file)
+    windows = plan_windows(total_seconds, window_seconds, window_overlap)
+    print(f"Processing {total_seconds:.1f}s in {len(windows)} windows of {window_seconds:.0f}s")
 
-    
-    
-    asr_pipeline = pipeline(
-        "automatic-speech-recognition",
-        model=cw_model,
-        tokenizer=processor.tokenizer,
-        feature_extractor=processor.feature_extractor,
-        chunk_length_s=30,         
-        batch_size=4,
-        return_timestamps='word',  
-        torch_dtype=torch_dtype,
-        device=0 if torch.cuda.is_available() else -1,
-        generate_kwargs={"language": "en"}
-    )
-    
+    session_id, session_dir = create_session()
+    yield "session", {"session_id": session_id}
+
+    audio_writer = SessionAudioWriter(session_id)
     segments_cw = []
     skipped_segments = []
-    segment_files = [f for f in os.listdir(session_dir) if f.endswith('.wav')]
-    for seg_file in sorted(segment_files):
+    known_speakers = []
+    prev_turns, prev_end = None, 0.0
+    transcript_path = os.path.join(session_dir, f"{session_id}_transcription.txt")
+    with open(transcript_path, "w", encoding="utf-8") as transcript_file:
+        for k, (start, end, own_start, own_end) in enumerate(windows):
+            progress = {"window": k + 1, "windows": len(windows)}
+            yield "stage", {"stage": "decode", **progress}
+            audio, native = decode_audio(input_audio_file, keep_native=save_segments and full_quality_segments,
+                                         start=start, duration=end - start)
 
-        match = re.match(r'^(\d+)-(\d+\.\d+)-(\d+\.\d+)-(.+)\.wav$', seg_file)
-        if not match:
-            continue
+            yield "stage", {"stage": "transcription", **progress}
+            result = model_pool.get(whisperx_name, device).transcribe(audio)
 
-        seg_session_id = match.group(1)
-        start_time = float(match.group(2))
-        end_time = float(match.group(3))
-        speaker = match.group(4)
-        seg_path = os.path.join(session_dir, seg_file)
-        
-        print(f"Processing segment with CrisperWhisper: {seg_path}")
-        try:
-            cw_output = asr_pipeline(seg_path)
-            cw_result = adjust_pauses_for_hf_pipeline_output(cw_output)
-        except Exception as e:
-            print(f"[Warning] CrisperWhisper error, skiped this segment: {seg_path}\nError Message: {e}")
-            skipped_segments.append(seg_path)
-            continue
-        
-        text = cw_result.get('text', '').strip()
-        if not text:
-            print(f"********** No text returned, skiped this segment: {seg_path} **********")
-            skipped_segments.append(seg_path)
-            continue
-        
-        chunks = cw_result.get('chunks', [])
-        words_info = []
-        for i, chunk in enumerate(chunks):
-            word_text = chunk['text'].strip()
-            if not word_text:
-                continue
-
-            chunk_start, chunk_end = chunk['timestamp']
-            
-            if chunk_start is None:
-                if i == 0:
-                    chunk_start = 0.0
-                else:
-                    chunk_start = words_info[-1]['end'] - start_time
-
-            if chunk_end is None:
-                if i < len(chunks) - 1:
-                    next_chunk_start, _ = chunks[i+1]['timestamp']
-                    if next_chunk_start is None:
-                        next_chunk_start = chunk_start
-                    chunk_end = next_chunk_start
-                else:
-                    chunk_end = end_time - start_time 
-
-            word_start = round(start_time + chunk_start, 3)
-            word_end = round(start_time + chunk_end, 3)
-            words_info.append({
-                "word": word_text,
-                "start": word_start,
-                "end": word_end
-            })
-        
-        segment_entry = {
-            "start": round(start_time, 3),
-            "end": round(end_time, 3),
-            "speaker": speaker,
-            "text": text,
-            "words": words_info
-        }
-        segments_cw.append(segment_entry)
-    
-    segments_cw = sorted(segments_cw, key=lambda x: x["start"])
-    cw_json_path = os.path.join(session_dir, f"{session_id}_transcriptionCW.json")
-    with open(cw_json_path, "w", encoding="utf-8") as f:
-        json.dump({"segments": segments_cw}, f, ensure_ascii=False, indent=4)
-    print(f"CrisperWhisper transcription saved to: {cw_json_path}")
-    
-    if skipped_segments:
-        skipped_file = os.path.join(session_dir, "skipped_segments.txt")
-        with open(skipped_file, "w", encoding="utf-8") as f:
-            for s in sorted(skipped_segments):
-                f.write(s + "\n")
-        print(f"Skipped segments recorded in: {skipped_file}")
-    
+            yield "stage", {"stage": "alignment", **progress}
+            segments = model_pool.get("align", device)(result["segments"], audio)["segments"]
+            del result
+
+            yield "stage", {"stage": "diarization", **progress}
+            diarization_segments = model_pool.get("diarization", device)(audio)
+            label_speakers(segments, diarization_segments)
+
+            turns = diarization_turns(diarization_segments, start)
+            speakers = match_speakers(prev_turns, turns, start, prev_end, known_speakers, num_speakers)
+            prev_turns = (turns[0], turns[1], [speakers[s] for s in turns[2]])
+            prev_end = end
+            del diarization_segments
+
+            for segment in segments:
+                segment["speaker"] = speakers.get(segment["speaker"], segment["speaker"])
+                shift_segment(segment, start)
+            segments = owned_segments(segments, own_start, own_end)
+            yield "diarization", {**progress, "segments": [
+                {"start": seg["start"], "end": seg["end"], "speaker": seg["speaker"], "text": seg["text"]}
+                for seg in segments]}
+
+            # Only the part this window owns goes into the session audio, so the
+            # stored samples line up with recording time.
+            offset_sample = seconds_to_sample(start)
+            audio_writer.append(audio[max(0, seconds_to_sample(own_start) - offset_sample):
+                                      max(0, seconds_to_sample(own_end) - offset_sample)])
+            segments_audio = cut_segments(segments, audio, session_id, offset=start)
+            if save_segments:
+                save_segment_wavs(segments_audio, session_id, session_dir, native, offset=start)
+            write_transcript_lines(transcript_file, segments)
+            del audio, native, segments
+
+            yield "stage", {"stage": "crisperwhisper", **progress}
+            yield from iter_crisperwhisper(model_pool, cw_devices, cw_name, segments_audio, segments_cw,
+                                           skipped_segments, segment_annotators)
+            del segments_audio
+
+    yield "stage", {"stage": "saving"}
+    audio_writer.finish()
+    write_session_outputs(session_id, session_dir, segments_cw, skipped_segments)
+    yield "done", {"session_id": session_id, "segments": len(segments_cw), "skipped": len(skipped_segments),
+                   "audio_seconds": total_seconds}
+
+def process_audio_file(input_audio_file, num_speakers, device="cuda", model_pool=None, save_segments=False,
+                       on_stage=None, full_quality_segments=False, window_seconds=None, cw_devices=None,
+                       precision=None):
+    # on_stage(name) is called as each pipeline stage starts (job status, progress).
+    session_id = None
+    events = iter_process_audio_file(input_audio_file, num_speakers, device=device, model_pool=model_pool,
+                                     save_segments=save_segments, full_quality_segments=full_quality_segments,
+                                     window_seconds=window_seconds, cw_devices=cw_devices, precision=precision)
+    for event, payload in observe_pipeline(events):
+        if event == "stage" and on_stage is not None:
+            on_stage(payload["stage"])
+        elif event == "done":
+            session_id = payload["session_id"]
     return session_id
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import os
+import sys
+import time
+import json
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+from session_store import session_path
+
+PROFILE_MODES = ("cprofile", "sampling", "torch")
+SAMPLE_INTERVAL = 0.005
+TOP_N = 15
+
+
+def parse_profile_modes(value):
+    """"1"/"true"/"all" -> every mode, "sampling,torch" -> those, ""/"0"/None -> None (off)."""
+    value = (value or "").strip().lower()
+    if value in ("", "0", "false", "no", "off"):
+        return None
+    if value in ("1", "true", "yes", "on", "all"):
+        return list(PROFILE_MODES)
+    modes = [mode.strip() for mode in value.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in PROFILE_MODES]
+    if unknown:
+        raise ValueError(f"Unknown profile mode(s) {', '.join(unknown)}, expected {', '.join(PROFILE_MODES)}")
+    return modes
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer into flamegraph-ready collapsed stacks."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, n=TOP_N):
+        # Leaf frames, i.e. where the samples were actually executing.
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [{"frame": frame, "samples": count, "share": round(count / total, 4)}
+                for frame, count in leaves.most_common(n)]
+
+
+class RequestProfiler:
+    """Profiles the code run inside `with` on the calling thread.
+
+    Modes: "cprofile" (deterministic, saved as .pstats), "sampling" (stack
+    samples, saved as collapsed stacks) and "torch" (torch.profiler over the
+    model calls, saved as a Chrome trace). Nothing is collected until the
+    block is entered, so requests that do not ask for it pay nothing.
+    """
+
+    def __init__(self, modes=PROFILE_MODES):
+        self.modes = list(modes)
+        self.wall_s = None
+        self.warnings = []
+        self._stages = []
+        self._cprofile = None
+        self._sampler = None
+        self._torch = None
+
+    def __enter__(self):
+        if "cprofile" in self.modes:
+            self._cprofile = cProfile.Profile()
+            try:
+                self._cprofile.enable()
+            except ValueError as e:  # another profiler is already running in this process
+                self.warnings.append(f"cprofile: {e}")
+                self._cprofile = None
+        if "sampling" in self.modes:
+            self._sampler = StackSampler(threading.get_ident())
+            self._sampler.start()
+        if "torch" in self.modes:
+            self._start_torch()
+        self._started = time.perf_counter()
+        return self
+
+    def _start_torch(self):
+        try:
+            import torch
+            from torch.profiler import profile, ProfilerActivity
+        except ImportError as e:
+            self.warnings.append(f"torch: {e}")
+            return
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        try:
+            self._torch = profile(activities=activities)
+            self._torch.__enter__()
+        except Exception as e:
+            self.warnings.append(f"torch: {e}")
+            self._torch = None
+
+    def mark_stage(self, stage):
+        # Usable as run_pipeline's on_stage; a "cached" stage means preprocessing was skipped.
+        self._stages.append((stage, time.perf_counter()))
+
+    def stage_seconds(self):
+        end = self._started + self.wall_s
+        times = [t for _, t in self._stages[1:]] + [end]
+        seconds = {}
+        for (stage, start), stop in zip(self._stages, times):
+            seconds[stage] = round(seconds.get(stage, 0.0) + stop - start, 3)
+        return seconds
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall_s = time.perf_counter() - self._started
+        if self._torch is not None:
+            self._torch.__exit__(None, None, None)
+        if self._sampler is not None:
+            self._sampler.stop()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        return False
+
+    def _cprofile_top(self, n=TOP_N):
+        stats = pstats.Stats(self._cprofile)
+        rows = []
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({"function": f"{name} ({os.path.basename(filename)}:{line})", "calls": calls,
+                         "tottime_s": round(tottime, 4), "cumtime_s": round(cumtime, 4)})
+        return sorted(rows, key=lambda row: -row["tottime_s"])[:n]
+
+    def _torch_top(self, n=TOP_N):
+        rows = []
+        for event in self._torch.key_averages():
+            device_us = getattr(event, "self_device_time_total", None)
+            if device_us is None:
+                device_us = getattr(event, "self_cuda_time_total", 0)
+            rows.append({"op": event.key, "calls": event.count,
+                         "self_cpu_ms": round(event.self_cpu_time_total / 1000, 3),
+                         "self_device_ms": round(device_us / 1000, 3)})
+        return sorted(rows, key=lambda row: -(row["self_cpu_ms"] + row["self_device_ms"]))[:n]
+
+    def save(self, session_id, base_dir="session_data"):
+        """Write the artifacts into the session directory; returns the hotspot summary."""
+        summary = {"modes": self.modes, "wall_s": round(self.wall_s, 3), "stages": self.stage_seconds(),
+                   "artifacts": {}}
+        if self._cprofile is not None:
+            path = session_path(session_id, "_profile.pstats", base_dir)
+            self._cprofile.dump_stats(path)
+            summary["artifacts"]["pstats"] = path
+            summary["cprofile_top"] = self._cprofile_top()
+        if self._sampler is not None:
+            path = session_path(session_id, "_profile.collapsed", base_dir)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self._sampler.collapsed())
+            summary["artifacts"]["collapsed_stacks"] = path
+            summary["samples"] = sum(self._sampler.stacks.values())
+            summary["sampled_top"] = self._sampler.top()
+        if self._torch is not None:
+            path = session_path(session_id, "_profile_trace.json", base_dir)
+            self._torch.export_chrome_trace(path)
+            summary["artifacts"]["chrome_trace"] = path
+            summary["torch_top"] = self._torch_top()
+        if self.warnings:
+            summary["warnings"] = self.warnings
+        with open(session_path(session_id, "_profile.json", base_dir), "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=4, ensure_ascii=False)
+        return summary
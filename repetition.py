@@ -1,54 +1,167 @@
-import os
-import json
+import numpy as np
+
+from annotation_engine import load_transcript, save_transcript
+
+def _repetition_object(tokens, i, L, count):
+    rep_count = count - 1
+    return {
+        "content": " ".join(tokens[i:i+L] * rep_count),
+        "words": list(range(i, i + rep_count * L)),
+        "mark_location": i + rep_count * L - 1
+    }
+
+def _find_repetitions_naive(tokens):
+    # Original algorithm: try every length from longest to shortest at every
+    # position. Roughly cubic; kept as the reference for find_repetitions.
+    reps = []
+    i = 0
+    n = len(tokens)
+    while i < n:
+        found = False
+        maxL = (n - i) // 2
+        for L in range(maxL, 0, -1):
+            if tokens[i:i+L] == tokens[i+L:i+2*L]:
+                count = 2
+                while i + count * L <= n and tokens[i:i+L] == tokens[i+(count-1)*L:i+count*L]:
+                    count += 1
+                count -= 1 
+                
+                reps.append(_repetition_object(tokens, i, L, count))
+                i += count * L 
+                found = True
+                break
+        if not found:
+            i += 1
+    return reps
+
+def _block_ranks(ids):
+    """ranks[k][i] names the block ids[i:i+2**k]: equal blocks, equal numbers (Karp-Miller-Rosenberg)."""
+    ranks = [np.asarray(ids, dtype=np.int64)]
+    step = 1
+    while 2 * step <= len(ids):
+        prev = ranks[-1]
+        pairs = prev[:len(prev) - step] * (len(ids) + 1) + prev[step:]
+        ranks.append(np.unique(pairs, return_inverse=True)[1].astype(np.int64).reshape(-1))
+        step *= 2
+    return ranks
+
+
+def _common_prefix(ranks, a, b, n):
+    """Vectorised length of the common prefix of ids[a:] and ids[b:], for a < b."""
+    a, b = a.copy(), b.copy()
+    length = np.zeros(len(a), dtype=np.int64)
+    for k in range(len(ranks) - 1, -1, -1):
+        step, rank = 1 << k, ranks[k]
+        ok = b + step <= n
+        last = len(rank) - 1
+        ok &= rank[np.minimum(a, last)] == rank[np.minimum(b, last)]
+        a += step * ok
+        b += step * ok
+        length += step * ok
+    return length
+
+
+def _common_suffix(ranks, a, b):
+    """Vectorised length of the common suffix of ids[:a] and ids[:b], for a < b."""
+    a, b = a.copy(), b.copy()
+    length = np.zeros(len(a), dtype=np.int64)
+    for k in range(len(ranks) - 1, -1, -1):
+        step, rank = 1 << k, ranks[k]
+        ok = a - step >= 0
+        ok &= rank[np.maximum(a - step, 0)] == rank[np.maximum(b - step, 0)]
+        a -= step * ok
+        b -= step * ok
+        length += step * ok
+    return length
+
+
+def _longest_squares(ranks, n):
+    """(longest, run_end): longest[i] is the largest L with ids[i:i+L] == ids[i+L:i+2L], or 0.
+
+    Every square lies in a run (a maximal stretch with period p, at least 2p
+    long) whose period divides L. Each run of period p contains two anchors
+    j, j+p with j a multiple of p, and is found by extending that pair both
+    ways; the sum of n/p anchors is O(n log n). Square occurrences with a
+    primitive root number O(n log n), which bounds filling in `longest`.
+    """
+    periods = np.concatenate([np.full(len(range(0, n - p, p)), p, dtype=np.int64) for p in range(1, n // 2 + 1)])
+    anchors = np.concatenate([np.arange(0, n - p, p, dtype=np.int64) for p in range(1, n // 2 + 1)])
+    forward = _common_prefix(ranks, anchors, anchors + periods, n)
+    backward = _common_suffix(ranks, anchors, anchors + periods)
+    keep = forward + backward >= periods
+    start = (anchors - backward)[keep]
+    end = (anchors + periods + forward)[keep]
+    period = periods[keep]
+    # Anchors of one run, and non-primitive periods of it, give the same
+    # (start, end): keep the smallest period once.
+    order = np.lexsort((period, end, start))
+    start, end, period = start[order], end[order], period[order]
+    first = np.ones(len(start), dtype=bool)
+    first[1:] = (start[1:] != start[:-1]) | (end[1:] != end[:-1])
+    start, end, period = start[first], end[first], period[first]
+
+    # Squares of period p start at start..end-2p; the longest at i is a
+    # multiple of p no longer than (end - i) / 2.
+    counts = end - 2 * period - start + 1
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.repeat(start, counts) + np.arange(counts.sum()) - offsets
+    period = np.repeat(period, counts)
+    end = np.repeat(end, counts)
+    lengths = period * ((end - positions) // (2 * period))
+    # The run's end rides along: period L (a multiple of p) holds from i up
+    # to it, so the repeat count is (end - i) // L.
+    best = np.zeros(n, dtype=np.int64)
+    np.maximum.at(best, positions, lengths * (n + 1) + end)
+    return best // (n + 1), best % (n + 1)
+
+
+def find_repetitions(tokens):
+    """Greedy tandem-repeat detection with the same output as the naive scan.
+
+    The longest square starting at every position comes from the runs of
+    the token stream (_longest_squares), together with where its run ends,
+    so each position the greedy scan visits is a lookup. O(n log^2 n)
+    overall, including on streams where one word recurs everywhere.
+    """
+    n = len(tokens)
+    if n < 2:
+        return []
+    ids_of = {}
+    ids = [ids_of.setdefault(t, len(ids_of)) for t in tokens]
+    ranks = _block_ranks(ids)
+    longest, run_end = (array.tolist() for array in _longest_squares(ranks, n))
+
+    reps = []
+    i = 0
+    while i < n:
+        L = longest[i]
+        if not L:
+            i += 1
+            continue
+        count = (run_end[i] - i) // L
+        reps.append(_repetition_object(tokens, i, L, count))
+        i += count * L
+    return reps
+
+def annotate_segment_repetitions(segment):
+    if "repetitions" in segment:
+        del segment["repetitions"]
+        
+    words_list = segment.get("words", [])
+    tokens = [w.get("word", "") for w in words_list]
+    segment["repetitions"] = find_repetitions(tokens)
+    return segment
 
 def annotate_repetitions(session_id, base_dir="session_data"):
 
-    session_dir = os.path.join(base_dir, session_id)
-    json_file = os.path.join(session_dir, f"{session_id}_transcriptionCW.json")
-    
-    if not os.path.exists(json_file):
-        print(f"Error: could not find {json_file}")
+    data = load_transcript(session_id, base_dir)
+    if data is None:
         return
     
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    
-    segments = data.get("segments", [])
-    for segment in segments:
-        if "repetitions" in segment:
-            del segment["repetitions"]
-            
-        words_list = segment.get("words", [])
-        tokens = [w.get("word", "") for w in words_list]
-        reps = []
-        i = 0
-        n = len(tokens)
-        while i < n:
-            found = False
-            maxL = (n - i) // 2
-            for L in range(maxL, 0, -1):
-                if tokens[i:i+L] == tokens[i+L:i+2*L]:
-                    count = 2
-                    while i + count * L <= n and tokens[i:i+L] == tokens[i+(count-1)*L:i+count*L]:
-                        count += 1
-                    count -= 1 
-                    
-                    rep_count = count - 1
-                    rep_obj = {
-                        "content": " ".join(tokens[i:i+L] * rep_count),
-                        "words": list(range(i, i + rep_count * L)),
-                        "mark_location": i + rep_count * L - 1
-                    }
-                    reps.append(rep_obj)
-                    i += count * L 
-                    found = True
-                    break
-            if not found:
-                i += 1
-        segment["repetitions"] = reps
+    for segment in data.get("segments", []):
+        annotate_segment_repetitions(segment)
     
-    with open(json_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    json_file = save_transcript(data, session_id, base_dir)
     
     print(f"Session {session_id} repetition annotation done: {json_file}")
     return data
@@ -0,0 +1,62 @@
+import gzip
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+
+
+def parse_fields(spec):
+    """"segments.text,segments.pauses,session_id" -> {"segments": {"text": {}, "pauses": {}}, "session_id": {}}.
+
+    An empty subtree keeps the whole value. Returns None when nothing was asked for.
+    """
+    if not spec:
+        return None
+    tree = {}
+    for path in spec.split(","):
+        path = path.strip()
+        if not path:
+            continue
+        node = tree
+        parts = path.split(".")
+        for i, part in enumerate(parts):
+            if part in node and not node[part]:
+                break  # an ancestor is already kept whole
+            child = node.setdefault(part, {})
+            if i == len(parts) - 1:
+                child.clear()
+            node = child
+    return tree or None
+
+
+def project(value, tree):
+    """Keep only the paths in `tree`; lists are projected element by element."""
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: project(value[key], subtree) for key, subtree in tree.items() if key in value}
+    return value
+
+
+def encode_json(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_response(value, accept_gzip=False):
+    """(body, headers) for a JSON response, gzipped when accepted and worth it."""
+    body = encode_json(value)
+    headers = {"Content-Type": "application/json"}
+    if accept_gzip and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return body, headers
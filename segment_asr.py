@@ -0,0 +1,131 @@
+import sys
+
+sys.path.append('./CrisperWhisper/')
+from utils import adjust_pauses_for_hf_pipeline_output
+
+SAMPLE_RATE = 16000
+BATCH_SIZE = 16
+MAX_LENGTH_RATIO = 1.5
+
+
+def chunks_to_words(chunks, start_time, end_time):
+    words_info = []
+    for i, chunk in enumerate(chunks):
+        word_text = chunk['text'].strip()
+        if not word_text:
+            continue
+
+        chunk_start, chunk_end = chunk['timestamp']
+
+        if chunk_start is None:
+            if i == 0 or not words_info:
+                chunk_start = 0.0
+            else:
+                chunk_start = words_info[-1]['end'] - start_time
+
+        if chunk_end is None:
+            if i < len(chunks) - 1:
+                next_chunk_start, _ = chunks[i+1]['timestamp']
+                if next_chunk_start is None:
+                    next_chunk_start = chunk_start
+                chunk_end = next_chunk_start
+            else:
+                chunk_end = end_time - start_time
+
+        word_start = round(start_time + chunk_start, 3)
+        word_end = round(start_time + chunk_end, 3)
+        words_info.append({
+            "word": word_text,
+            "start": word_start,
+            "end": word_end
+        })
+    return words_info
+
+
+def bucket_segments(segments, batch_size=BATCH_SIZE, max_length_ratio=MAX_LENGTH_RATIO):
+    # Shortest first; a bucket is closed when it is full or when the next
+    # segment is much longer than the bucket's first one.
+    buckets = []
+    current = []
+    for seg in sorted(segments, key=lambda x: x["end"] - x["start"]):
+        duration = max(seg["end"] - seg["start"], 1.0)
+        if current and (len(current) >= batch_size or
+                        duration > max(current[0]["end"] - current[0]["start"], 1.0) * max_length_ratio):
+            buckets.append(current)
+            current = []
+        current.append(seg)
+    if current:
+        buckets.append(current)
+    return buckets
+
+
+def _pipeline_input(seg):
+    # The HF pipeline pops keys from its input dict, so build a fresh one per call.
+    return {"raw": seg["audio"], "sampling_rate": SAMPLE_RATE}
+
+
+def _run_bucket(asr_pipeline, bucket):
+    try:
+        return asr_pipeline([_pipeline_input(seg) for seg in bucket], batch_size=len(bucket))
+    except Exception as e:
+        if len(bucket) == 1:
+            return [e]
+        print(f"[Warning] CrisperWhisper batch of {len(bucket)} failed, retrying one by one: {e}")
+    outputs = []
+    for seg in bucket:
+        try:
+            outputs.append(asr_pipeline(_pipeline_input(seg)))
+        except Exception as e:
+            outputs.append(e)
+    return outputs
+
+
+def build_segment_entry(seg, cw_output):
+    name = seg.get("name", f"{seg['start']:.2f}-{seg['end']:.2f}")
+    if isinstance(cw_output, Exception):
+        print(f"[Warning] CrisperWhisper error, skiped this segment: {name}\nError Message: {cw_output}")
+        return None
+    cw_result = adjust_pauses_for_hf_pipeline_output(cw_output)
+
+    text = cw_result.get('text', '').strip()
+    if not text:
+        print(f"********** No text returned, skiped this segment: {name} **********")
+        return None
+
+    entry = {
+        "start": round(seg["start"], 3),
+        "end": round(seg["end"], 3),
+        "speaker": seg["speaker"],
+        "text": text,
+        "words": chunks_to_words(cw_result.get('chunks', []), seg["start"], seg["end"])
+    }
+    if "start_sample" in seg:
+        # Offsets into the session audio (audio_io.load_session_audio).
+        entry["start_sample"] = seg["start_sample"]
+        entry["end_sample"] = seg["end_sample"]
+    return entry
+
+
+def iter_transcribe_segments(asr_pipeline, segments, batch_size=BATCH_SIZE):
+    """Yield (segment, entry) as each length bucket finishes; entry is None for skipped segments."""
+    empty = [seg for seg in segments if len(seg["audio"]) == 0]
+    for seg in empty:
+        print(f"********** Empty audio, skiped this segment: {seg.get('name')} **********")
+        yield seg, None
+
+    buckets = bucket_segments([seg for seg in segments if len(seg["audio"]) > 0], batch_size)
+    print(f"Transcribing {len(segments) - len(empty)} segments with CrisperWhisper in {len(buckets)} batches")
+    for bucket in buckets:
+        for seg, cw_output in zip(bucket, _run_bucket(asr_pipeline, bucket)):
+            yield seg, build_segment_entry(seg, cw_output)
+
+
+def transcribe_segments(asr_pipeline, segments, batch_size=BATCH_SIZE):
+    segments_cw = []
+    skipped_segments = []
+    for seg, entry in iter_transcribe_segments(asr_pipeline, segments, batch_size):
+        if entry is None:
+            skipped_segments.append(seg.get("name"))
+        else:
+            segments_cw.append(entry)
+    return sorted(segments_cw, key=lambda x: x["start"]), skipped_segments
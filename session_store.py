@@ -0,0 +1,97 @@
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows: allocation still relies on os.mkdir being exclusive.
+    fcntl = None
+
+SESSION_ROOT = "session_data"
+COUNTER_FILE = ".session_counter"
+SHARD_DIGITS = 3
+ID_DIGITS = 6
+
+
+def shard_name(session_id):
+    # Up to 10**SHARD_DIGITS sessions per shard directory.
+    return session_id[:-SHARD_DIGITS]
+
+
+def session_dir(session_id, base_dir=SESSION_ROOT):
+    """Directory of a session: base/<shard>/<id>, or base/<id> for sessions made before sharding."""
+    legacy = os.path.join(base_dir, session_id)
+    if os.path.isdir(legacy):
+        return legacy
+    return os.path.join(base_dir, shard_name(session_id), session_id)
+
+
+def session_path(session_id, suffix, base_dir=SESSION_ROOT):
+    """Path of a per-session file named <id><suffix>, e.g. session_path(sid, "_gaps.npz")."""
+    return os.path.join(session_dir(session_id, base_dir), f"{session_id}{suffix}")
+
+
+def session_file(session_id, name, base_dir=SESSION_ROOT):
+    return os.path.join(session_dir(session_id, base_dir), name)
+
+
+def _is_session_name(name):
+    # Shard names are shorter than ids until ids outgrow ID_DIGITS + SHARD_DIGITS digits.
+    return name.isdigit() and len(name) >= ID_DIGITS
+
+
+def _scan_max_id(base_dir):
+    highest = 0
+    for name in os.listdir(base_dir):
+        if not name.isdigit() or not os.path.isdir(os.path.join(base_dir, name)):
+            continue
+        if _is_session_name(name):
+            highest = max(highest, int(name))
+        else:
+            for inner in os.listdir(os.path.join(base_dir, name)):
+                if _is_session_name(inner):
+                    highest = max(highest, int(inner))
+    return highest
+
+
+def _read_counter(path, base_dir):
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        # First run, or the counter was lost: seed it from what is on disk once.
+        return _scan_max_id(base_dir)
+
+
+def _write_counter(path, value):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(str(value))
+    os.replace(tmp, path)
+
+
+def create_session(base_dir=SESSION_ROOT):
+    """Allocate the next session id and create its directory; returns (session_id, session_dir).
+
+    The counter file is updated under an exclusive lock, and the directory is
+    created with os.mkdir so two processes can never end up sharing one.
+    """
+    os.makedirs(base_dir, exist_ok=True)
+    counter_path = os.path.join(base_dir, COUNTER_FILE)
+    with open(f"{counter_path}.lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            next_id = _read_counter(counter_path, base_dir) + 1
+            while True:
+                session_id = f"{next_id:0{ID_DIGITS}d}"
+                path = os.path.join(base_dir, shard_name(session_id), session_id)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.mkdir(path)
+                    break
+                except FileExistsError:
+                    next_id += 1
+            _write_counter(counter_path, next_id)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    return session_id, path
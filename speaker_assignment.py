@@ -0,0 +1,52 @@
+import numpy as np
+
+
+def build_speaker_index(diarization_segments):
+    starts = np.asarray(diarization_segments["start"], dtype=float)
+    ends = np.asarray(diarization_segments["end"], dtype=float)
+    speakers = list(diarization_segments["speaker"])
+    order = np.argsort(starts, kind="stable")
+    sorted_ends = ends[order]
+    # Running max of the end times: every turn before the first position where
+    # it exceeds t ends at or before t and cannot overlap anything after t.
+    max_ends = np.maximum.accumulate(sorted_ends) if len(order) else sorted_ends
+    return {
+        "order": order,
+        "starts": starts[order],
+        "ends": sorted_ends,
+        "max_ends": max_ends,
+        "speakers": speakers,
+    }
+
+
+def lookup_speaker(index, start, end, default="Unknown"):
+    lo = np.searchsorted(index["max_ends"], start, side="right")
+    hi = np.searchsorted(index["starts"], end, side="left")
+    if lo >= hi:
+        return default
+    overlap = np.minimum(end, index["ends"][lo:hi]) - np.maximum(start, index["starts"][lo:hi])
+    best = overlap.max()
+    if best <= 0:
+        return default
+    # Ties go to the turn that comes first in the diarization output, like the
+    # original row-by-row scan did.
+    first = index["order"][lo:hi][overlap == best].min()
+    return index["speakers"][int(first)]
+
+
+def assign_speakers(segments, diarization_segments, return_word_speakers=False):
+    index = build_speaker_index(diarization_segments)
+    speaker_map = {}
+    word_speakers = []
+    for segment in segments:
+        speaker = lookup_speaker(index, segment["start"], segment["end"])
+        speaker_map[segment["start"]] = speaker
+        if return_word_speakers:
+            word_speakers.append([
+                lookup_speaker(index, w["start"], w["end"], default=speaker)
+                if "start" in w and "end" in w else speaker
+                for w in segment.get("words", [])
+            ])
+    if return_word_speakers:
+        return speaker_map, word_speakers
+    return speaker_map
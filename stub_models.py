@@ -0,0 +1,158 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+SAMPLE_RATE = 16000
+FRAME_SECONDS = 0.02
+VOICED_RMS = 0.05
+# One steady tone per synthetic speaker; the stub diarization tells them apart by pitch.
+SPEAKER_PITCHES = (140.0, 230.0, 330.0, 450.0, 600.0)
+WORDS = ["the", "boy", "and", "his", "dog", "looked", "for", "frog", "in", "jar", "um", "uh",
+         "then", "he", "went", "out", "to", "find", "it", "like"]
+MAX_SEGMENT_SECONDS = 30.0
+
+
+def synthetic_recording(path, seconds, num_speakers=2, seed=0):
+    """Write a 16 kHz WAV of alternating speakers; returns the number of turns.
+
+    Each turn is a run of short tone bursts ("words") at the speaker's pitch
+    separated by gaps of varying length, so pauses exist inside turns and
+    between them. The file is written turn by turn, so hours of audio never
+    sit in memory.
+    """
+    if not 1 <= num_speakers <= len(SPEAKER_PITCHES):
+        raise ValueError(f"num_speakers must be between 1 and {len(SPEAKER_PITCHES)}")
+    rng = np.random.default_rng(seed)
+    total = int(seconds * SAMPLE_RATE)
+    written = 0
+    turns = 0
+    speaker = 0
+    with sf.SoundFile(path, "w", SAMPLE_RATE, 1, subtype="PCM_16") as f:
+        while written < total:
+            if num_speakers > 1:
+                speaker = (speaker + int(rng.integers(1, num_speakers))) % num_speakers
+            pieces = [np.zeros(int(rng.uniform(0.3, 1.2) * SAMPLE_RATE), dtype=np.float32)]
+            for _ in range(int(rng.integers(3, 20))):
+                t = np.arange(int(rng.uniform(0.15, 0.5) * SAMPLE_RATE)) / SAMPLE_RATE
+                pieces.append((0.3 * np.sin(2 * np.pi * SPEAKER_PITCHES[speaker] * t)).astype(np.float32))
+                pieces.append(np.zeros(int(rng.choice([0.06, 0.1, 0.2, 0.45]) * SAMPLE_RATE), dtype=np.float32))
+            turn = np.concatenate(pieces)[:total - written]
+            f.write(turn)
+            written += len(turn)
+            turns += 1
+    return turns
+
+
+def voiced_regions(audio, min_gap):
+    """(start, end) seconds of stretches above VOICED_RMS, joining gaps shorter than `min_gap`."""
+    frame = int(FRAME_SECONDS * SAMPLE_RATE)
+    n = len(audio) // frame
+    if n == 0:
+        return []
+    frames = np.asarray(audio[:n * frame], dtype=np.float32).reshape(n, frame)
+    voiced = np.sqrt((frames ** 2).mean(axis=1)) > VOICED_RMS
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], voiced.astype(np.int8), [0]])))
+    regions = []
+    for start, end in zip(edges[::2] * FRAME_SECONDS, edges[1::2] * FRAME_SECONDS):
+        if regions and start - regions[-1][1] < min_gap:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return [(float(start), float(end)) for start, end in regions]
+
+
+def _pick_words(n, seed):
+    rng = np.random.default_rng(seed)
+    words = []
+    for _ in range(n):
+        # Some stutters so the repetition annotator has work to do.
+        if words and rng.random() < 0.1:
+            words.append(words[-1])
+        else:
+            words.append(WORDS[int(rng.integers(len(WORDS)))])
+    return words
+
+
+def _seed(*values):
+    return zlib.crc32(repr(values).encode("utf-8"))
+
+
+class StubWhisperX:
+    def transcribe(self, audio, **kwargs):
+        segments = []
+        for start, end in voiced_regions(audio, min_gap=0.6):
+            while start < end:
+                stop = min(end, start + MAX_SEGMENT_SECONDS)
+                words = _pick_words(max(1, round((stop - start) * 2.5)), _seed(round(start, 2)))
+                segments.append({"start": round(start, 3), "end": round(stop, 3), "text": " ".join(words)})
+                start = stop
+        return {"segments": segments, "language": "en"}
+
+
+def stub_align(segments, audio):
+    aligned = []
+    for seg in segments:
+        words = seg["text"].split()
+        step = (seg["end"] - seg["start"]) / max(len(words), 1)
+        aligned.append({**seg, "words": [
+            {"word": w, "start": round(seg["start"] + k * step, 3), "end": round(seg["start"] + (k + 1) * step, 3),
+             "score": 1.0}
+            for k, w in enumerate(words)]})
+    return {"segments": aligned, "word_segments": [w for seg in aligned for w in seg["words"]]}
+
+
+def stub_diarization(audio, **kwargs):
+    rows = []
+    for start, end in voiced_regions(audio, min_gap=0.1):
+        burst = np.asarray(audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)])
+        pitch = np.count_nonzero(np.diff(np.signbit(burst))) / 2 / max(end - start, FRAME_SECONDS)
+        speaker = f"SPEAKER_{int(np.argmin([abs(pitch - p) for p in SPEAKER_PITCHES])):02d}"
+        if rows and rows[-1]["speaker"] == speaker:
+            rows[-1]["end"] = end
+        else:
+            rows.append({"start": start, "end": end, "speaker": speaker})
+    return pd.DataFrame(rows, columns=["start", "end", "speaker"])
+
+
+class StubCrisperWhisper:
+    """Stands in for the HF ASR pipeline: one word per tone burst, with its timestamps."""
+
+    def _one(self, item):
+        regions = voiced_regions(item["raw"], min_gap=0.04)
+        words = _pick_words(len(regions), _seed(len(item["raw"]), len(regions)))
+        chunks = [{"text": f" {w}", "timestamp": (round(s, 2), round(e, 2))} for w, (s, e) in zip(words, regions)]
+        return {"text": " ".join(words), "chunks": chunks}
+
+    def __call__(self, inputs, batch_size=None, **kwargs):
+        if isinstance(inputs, dict):
+            return self._one(inputs)
+        return [self._one(item) for item in inputs]
+
+
+def load_whisperx(device):
+    return StubWhisperX()
+
+
+def load_align(device):
+    return stub_align
+
+
+def load_diarization(device):
+    return stub_diarization
+
+
+def load_crisperwhisper(device):
+    return StubCrisperWhisper()
+
+
+# ModelPool(loaders=STUB_LOADERS): deterministic, CPU-only and instant to load.
+STUB_LOADERS = {
+    "whisperx": load_whisperx,
+    "align": load_align,
+    "diarization": load_diarization,
+    "crisperwhisper": load_crisperwhisper,
+    "whisperx@int8": load_whisperx,
+    "crisperwhisper@int8": load_crisperwhisper,
+}
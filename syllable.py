@@ -1,41 +1,63 @@
 import os
 import json
+import pickle
 import re
 import string
+import sys
+from functools import lru_cache
+
+from annotation_engine import load_transcript, save_transcript
+
+custom_dict_path = "./syllable_dict_ENNI_refine.json"
+compiled_dict_path = "./syllable_dict_ENNI_refine.pkl"
+WORD_CACHE_SIZE = 8192
 
 # Load Dict
 def load_custom_dict(dict_path):
     with open(dict_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-custom_dict_path = "./syllable_dict_ENNI_refine.json"
-custom_dict = load_custom_dict(custom_dict_path)
-
 vowels_phonemes = [
     "iː", "uː", "ɜː", "ɔː", "ɑː",
     "ɪ", "ʊ", "e", "ə", "æ", "ʌ", "ɛ", "ɒ",
     "eɪ", "aɪ", "ɔɪ", "aʊ", "əʊ", "ɪə", "eə", "ʊə"
 ]
+_vowels_sorted = sorted(vowels_phonemes, key=len, reverse=True)
+_vowel_set = frozenset(vowels_phonemes)
+
+_custom_dict = None
+_syllable_table = None
+
+def get_custom_dict():
+    global _custom_dict
+    if _custom_dict is None:
+        _custom_dict = load_custom_dict(custom_dict_path)
+    return _custom_dict
+
+def __getattr__(name):
+    # `custom_dict` used to be loaded at import time; keep it available lazily.
+    if name == "custom_dict":
+        return get_custom_dict()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def phoneme_type(phoneme):
-    return 'V' if phoneme in vowels_phonemes else 'C'
+    return 'V' if phoneme in _vowel_set else 'C'
 
 def get_pronunciation_from_dict(word):
     clean_word = word.strip(string.punctuation).lower()
-    return custom_dict.get(clean_word, "")
+    return get_custom_dict().get(clean_word, "")
 
 def split_ipa_into_syllables(ipa_str):
     ipa_str = ipa_str.replace("ˈ", ".").replace("ˌ", ".")
     return [s for s in ipa_str.split('.') if s.strip()]
 
 def split_syllable_into_phonemes(syllable):
-    vowels_sorted = sorted(vowels_phonemes, key=len, reverse=True)
     phonemes = []
     i = 0
     while i < len(syllable):
         matched = None
-        for v in vowels_sorted:
-            if syllable[i:i+len(v)] == v:
+        for v in _vowels_sorted:
+            if syllable.startswith(v, i):
                 matched = v
                 break
         if matched:
@@ -46,49 +68,84 @@ def split_syllable_into_phonemes(syllable):
             i += 1
     return phonemes
 
-def analyze_word_syllables(word):
-    ipa_str = get_pronunciation_from_dict(word)
-    if not ipa_str:
-        return []
-    syllables_ipa = split_ipa_into_syllables(ipa_str)
-    syllable_data = []
-    for syl in syllables_ipa:
+def compile_syllables(ipa_str):
+    compiled = []
+    for syl in split_ipa_into_syllables(ipa_str):
         phs = split_syllable_into_phonemes(syl)
-        CV = ''.join(phoneme_type(p) for p in phs)
-        syllable_data.append({
-            "syllable": ''.join(phs),
-            "phonemes": phs,
-            "CV_pattern": CV
-        })
-    return syllable_data
+        # Interned so pickle stores each repeated phoneme/pattern string once.
+        compiled.append((
+            sys.intern(''.join(phs)),
+            tuple(sys.intern(p) for p in phs),
+            sys.intern(''.join(phoneme_type(p) for p in phs))
+        ))
+    return tuple(compiled)
+
+def compile_syllable_dict(dict_path=custom_dict_path, output_path=compiled_dict_path):
+    """Precompile the IPA dictionary into word -> ((syllable, phonemes, CV), ...)."""
+    table = {word: compile_syllables(ipa) for word, ipa in load_custom_dict(dict_path).items() if ipa}
+    if output_path:
+        # Written aside and renamed, so a concurrent reader never sees half a pickle.
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, output_path)
+        print(f"Compiled syllable table written to {output_path}")
+    return table
+
+def get_syllable_table():
+    global _syllable_table
+    if _syllable_table is None:
+        if (os.path.exists(compiled_dict_path) and
+                os.path.getmtime(compiled_dict_path) >= os.path.getmtime(custom_dict_path)):
+            try:
+                with open(compiled_dict_path, "rb") as f:
+                    _syllable_table = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError) as e:
+                print(f"[Warning] Compiled syllable table {compiled_dict_path} is unreadable ({e}), rebuilding it")
+        if _syllable_table is None:
+            try:
+                _syllable_table = compile_syllable_dict()
+            except OSError:
+                _syllable_table = compile_syllable_dict(output_path=None)
+    return _syllable_table
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def _lookup_syllables(word):
+    clean_word = word.strip(string.punctuation).lower()
+    return get_syllable_table().get(clean_word, ())
+
+def analyze_word_syllables(word):
+    # Fresh dicts every call: annotate_segment_syllables adds word_index to them.
+    return [
+        {"syllable": syllable, "phonemes": list(phonemes), "CV_pattern": cv}
+        for syllable, phonemes, cv in _lookup_syllables(word)
+    ]
+
+def annotate_segment_syllables(segment):
+    words_info = segment.get("words", [])
+    syllables = []
+
+    for idx, word_obj in enumerate(words_info):
+        word = word_obj.get("word", "")
+        if re.fullmatch(r"\[.*?\]", word):  # 跳过 filler
+            continue
+        word_syllables = analyze_word_syllables(word)
+        for syl in word_syllables:
+            syl["word_index"] = idx
+        syllables.extend(word_syllables)
+
+    segment["syllables"] = syllables
+    return segment
 
 def annotate_syllables(session_id, base_dir="session_data"):
-    json_file = os.path.join(base_dir, session_id, f"{session_id}_transcriptionCW.json")
-    if not os.path.exists(json_file):
-        print(f"[Error] Cannot find file: {json_file}")
+    data = load_transcript(session_id, base_dir)
+    if data is None:
         return
 
-    with open(json_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
     for segment in data.get("segments", []):
-        text = segment.get("text", "")
-        words_info = segment.get("words", [])
-        syllables = []
-
-        for idx, word_obj in enumerate(words_info):
-            word = word_obj.get("word", "")
-            if re.fullmatch(r"\[.*?\]", word):  # 跳过 filler
-                continue
-            word_syllables = analyze_word_syllables(word)
-            for syl in word_syllables:
-                syl["word_index"] = idx
-            syllables.extend(word_syllables)
-
-        segment["syllables"] = syllables
-
-    with open(json_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+        annotate_segment_syllables(segment)
+
+    json_file = save_transcript(data, session_id, base_dir)
 
     print(f"Session {session_id} syllable annotation done: {json_file}")
     return data
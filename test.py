@@ -1,9 +1,6 @@
 import os
 from preprocess import process_audio_file
-from pause import annotate_pauses
-from repetition import annotate_repetitions
-from syllable import annotate_syllables
-from fillerword import annotate_fillerwords
+from annotation_engine import annotate_session
 from mispronunciation import annotate_mispronunciation
 
 from feature_extraction import feature_extraction
@@ -19,20 +16,19 @@ def main():
 
     print("Start init...")
     
+    # annotate_mispronunciation uploads slices of the stored session audio
     session_id = process_audio_file(input_audio_file, num_speakers=2, device=device)
 
     # annotation
-    annotate_pauses(session_id, pause_threshold)
-    annotate_repetitions(session_id)
-    annotate_syllables(session_id)
-    annotate_fillerwords(session_id)
+    data = annotate_session(session_id, ["pauses", "repetitions", "syllables", "fillerwords"],
+                            pause_threshold=pause_threshold)
     # annotate_mispronunciation(session_id, api_url="http://localhost:8080")
     
     # feature extraction
     # feature_extraction(session_id)
 
     # transcription generation
-    output_annotation = annotate_transcript(session_id)
+    output_annotation = annotate_transcript(session_id, data=data)
     print(f"Done: {output_annotation}")
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+import json
+import argparse
+
+import numpy as np
+
+WORD_KEYS = ("word", "start", "end")
+# How a word's start/end was written in the JSON, so it round-trips exactly.
+FLOAT, INT, NONE = 0, 1, 2
+
+
+def _json_bytes(value):
+    return np.frombuffer(json.dumps(value, ensure_ascii=False).encode("utf-8"), dtype=np.uint8)
+
+
+def _from_json_bytes(array):
+    return json.loads(array.tobytes().decode("utf-8"))
+
+
+def _time_kind(value):
+    if value is None:
+        return NONE
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        return FLOAT
+    if isinstance(value, int):
+        return INT
+    return None
+
+
+def _is_plain_word(word):
+    return (isinstance(word, dict) and tuple(word) == WORD_KEYS and isinstance(word["word"], str)
+            and _time_kind(word["start"]) is not None and _time_kind(word["end"]) is not None)
+
+
+def to_columns(data):
+    """Columnar form of a transcript: one array per word field plus segment offsets.
+
+    Words shaped like {"word", "start", "end"} go into the arrays (text as ids
+    into `vocab`); everything else, including segment fields, annotations and
+    any unusual word, is kept as JSON so from_columns gives back the same data.
+    """
+    vocab, vocab_ids = [], {}
+    word_id, word_start, word_end, start_kind, end_kind = [], [], [], [], []
+    extra_index, extra_words = [], []
+    offsets = [0]
+    segment_meta = []
+    has_words = []
+
+    segments = data.get("segments", [])
+    for segment in segments:
+        words = segment.get("words")
+        if not isinstance(words, list):
+            segment_meta.append(segment)
+            has_words.append(False)
+            offsets.append(offsets[-1])
+            continue
+        # "words" stays in the dict as a placeholder so the key order survives.
+        segment_meta.append({**segment, "words": None})
+        has_words.append(True)
+        for word in words:
+            if _is_plain_word(word):
+                text = word["word"]
+                if text not in vocab_ids:
+                    vocab_ids[text] = len(vocab)
+                    vocab.append(text)
+                word_id.append(vocab_ids[text])
+                start_kind.append(_time_kind(word["start"]))
+                end_kind.append(_time_kind(word["end"]))
+                word_start.append(np.nan if word["start"] is None else word["start"])
+                word_end.append(np.nan if word["end"] is None else word["end"])
+            else:
+                extra_index.append(len(word_id))
+                extra_words.append(word)
+                word_id.append(-1)
+                start_kind.append(NONE)
+                end_kind.append(NONE)
+                word_start.append(np.nan)
+                word_end.append(np.nan)
+        offsets.append(len(word_id))
+
+    meta = {key: (None if key == "segments" else value) for key, value in data.items()}
+    return {
+        "vocab": np.array(vocab, dtype=str),
+        "word_id": np.array(word_id, dtype=np.int32),
+        "word_start": np.array(word_start, dtype=np.float64),
+        "word_end": np.array(word_end, dtype=np.float64),
+        "start_kind": np.array(start_kind, dtype=np.int8),
+        "end_kind": np.array(end_kind, dtype=np.int8),
+        "segment_offsets": np.array(offsets, dtype=np.int64),
+        "has_words": np.array(has_words, dtype=bool),
+        "segment_speaker": np.array([str(segment.get("speaker") or "") for segment in segments], dtype=str),
+        "segment_meta": _json_bytes(segment_meta),
+        "extra_index": np.array(extra_index, dtype=np.int64),
+        "extra_words": _json_bytes(extra_words),
+        "meta": _json_bytes(meta),
+    }
+
+
+def _times(values, kinds):
+    out = values.tolist()
+    for i in np.flatnonzero(kinds != FLOAT).tolist():
+        out[i] = None if kinds[i] == NONE else int(values[i])
+    return out
+
+
+def from_columns(columns):
+    """Inverse of to_columns: the transcript in the JSON schema."""
+    vocab = columns["vocab"].tolist()
+    texts = [vocab[i] if i >= 0 else None for i in columns["word_id"].tolist()]
+    starts = _times(columns["word_start"], columns["start_kind"])
+    ends = _times(columns["word_end"], columns["end_kind"])
+    words = [{"word": w, "start": s, "end": e} for w, s, e in zip(texts, starts, ends)]
+    for i, word in zip(columns["extra_index"].tolist(), _from_json_bytes(columns["extra_words"])):
+        words[i] = word
+
+    offsets = columns["segment_offsets"].tolist()
+    segments = _from_json_bytes(columns["segment_meta"])
+    for k, (segment, has_words) in enumerate(zip(segments, columns["has_words"].tolist())):
+        if has_words:
+            segment["words"] = words[offsets[k]:offsets[k + 1]]
+
+    data = _from_json_bytes(columns["meta"])
+    if "segments" in data:
+        data["segments"] = segments
+    return data
+
+
+def save_columns(columns, path):
+    with open(path, "wb") as f:
+        np.savez_compressed(f, **columns)
+    return path
+
+
+def load_columns(path):
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def has_plain_times(columns):
+    # True when every word time is a number, so the arrays can be used as they are.
+    return (len(columns["extra_index"]) == 0 and not (columns["start_kind"] == NONE).any()
+            and not (columns["end_kind"] == NONE).any())
+
+
+def convert_session(session_id, to_format, base_dir="session_data"):
+    """Rewrite a session's transcript as "json" or "npz"; returns the new path."""
+    from annotation_engine import load_transcript, save_transcript
+    data = load_transcript(session_id, base_dir)
+    if data is None:
+        return None
+    return save_transcript(data, session_id, base_dir, transcript_format=to_format)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert session transcripts between JSON and columnar .npz")
+    parser.add_argument("format", choices=["json", "npz"])
+    parser.add_argument("session_ids", nargs="+")
+    parser.add_argument("--base-dir", default="session_data")
+    args = parser.parse_args()
+    for sid in args.session_ids:
+        path = convert_session(sid, args.format, args.base_dir)
+        if path:
+            print(f"Session {sid} transcript converted: {path}")
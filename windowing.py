@@ -0,0 +1,92 @@
+import numpy as np
+
+WINDOW_SECONDS = 600.0
+WINDOW_OVERLAP = 30.0
+
+
+def plan_windows(total_seconds, window_seconds=WINDOW_SECONDS, overlap=WINDOW_OVERLAP):
+    """Overlapping (start, end, own_start, own_end) windows covering the recording.
+
+    Each window owns the middle of its overlaps with its neighbours; a segment
+    is kept by the window that owns its midpoint, so every segment is kept once.
+    """
+    if window_seconds <= overlap:
+        raise ValueError("window_seconds must be longer than the overlap")
+    stride = window_seconds - overlap
+    starts = [0.0]
+    while starts[-1] + window_seconds < total_seconds:
+        starts.append(starts[-1] + stride)
+    windows = []
+    for k, start in enumerate(starts):
+        end = min(start + window_seconds, total_seconds)
+        own_start = 0.0 if k == 0 else start + overlap / 2
+        own_end = total_seconds if k == len(starts) - 1 else start + stride + overlap / 2
+        windows.append((start, end, own_start, own_end))
+    return windows
+
+
+def shift_segment(segment, offset):
+    """Move a WhisperX segment (and its words) from window time to recording time."""
+    # WhisperX times are rounded to milliseconds; keep them that way after the shift.
+    segment["start"] = round(segment["start"] + offset, 3)
+    segment["end"] = round(segment["end"] + offset, 3)
+    for word in segment.get("words", []):
+        if "start" in word:
+            word["start"] = round(word["start"] + offset, 3)
+        if "end" in word:
+            word["end"] = round(word["end"] + offset, 3)
+    return segment
+
+
+def owned_segments(segments, own_start, own_end):
+    return [seg for seg in segments if own_start <= (seg["start"] + seg["end"]) / 2 < own_end]
+
+
+def diarization_turns(diarization_segments, offset):
+    """(starts, ends, speakers) of a window's diarization in recording time."""
+    starts = np.asarray(diarization_segments["start"], dtype=float) + offset
+    ends = np.asarray(diarization_segments["end"], dtype=float) + offset
+    return starts, ends, list(diarization_segments["speaker"])
+
+
+def _clipped_overlap(starts_a, ends_a, starts_b, ends_b, lo, hi):
+    a_s, a_e = np.clip(starts_a, lo, hi), np.clip(ends_a, lo, hi)
+    b_s, b_e = np.clip(starts_b, lo, hi), np.clip(ends_b, lo, hi)
+    return np.maximum(0.0, np.minimum(a_e[:, None], b_e[None, :]) - np.maximum(a_s[:, None], b_s[None, :]))
+
+
+def match_speakers(prev_turns, cur_turns, overlap_start, overlap_end, known_labels, max_speakers=None):
+    """Map a window's local speaker labels onto the labels used so far.
+
+    Local and previous labels are paired by how long they speak at the same
+    time inside the shared overlap region (one-to-one, largest total first).
+    Local speakers with no counterpart get a new SPEAKER_NN label, unless
+    `max_speakers` labels exist already; then they take a known label that
+    this window has not used, since they are someone heard before.
+    """
+    cur_starts, cur_ends, cur_speakers = cur_turns
+    local = sorted(set(cur_speakers))
+    mapping = {}
+    if prev_turns is not None and len(local) and len(prev_turns[2]):
+        prev_starts, prev_ends, prev_speakers = prev_turns
+        known = sorted(set(prev_speakers))
+        pair = _clipped_overlap(cur_starts, cur_ends, prev_starts, prev_ends, overlap_start, overlap_end)
+        cur_idx = np.array([local.index(s) for s in cur_speakers])
+        prev_idx = np.array([known.index(s) for s in prev_speakers])
+        totals = np.zeros((len(local), len(known)))
+        np.add.at(totals, (cur_idx[:, None], prev_idx[None, :]), pair)
+        while totals.size and totals.max() > 0:
+            r, c = np.unravel_index(np.argmax(totals), totals.shape)
+            mapping[local[r]] = known[c]
+            totals[r, :] = 0
+            totals[:, c] = 0
+    for label in local:
+        if label in mapping:
+            continue
+        unused = [known for known in known_labels if known not in mapping.values()]
+        if max_speakers and len(known_labels) >= max_speakers and unused:
+            mapping[label] = unused[0]
+        else:
+            mapping[label] = f"SPEAKER_{len(known_labels):02d}"
+            known_labels.append(mapping[label])
+    return mapping